@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from pytz import timezone
+
+from benchmarks.live_aggs_benchmark import make_frames, make_symbols
+from data.live_aggs import LiveAggregates
+from data.minute_bars import MinuteBarBuffer
+from data.movers import MoversIndex
+from data.ws_journal import JournalWriter, read_frames
+
+"""
+Replays a websocket journal through the ingestion path of the websocket thread, decoding every frame and folding its
+'AM' bars into live aggregates with minute bars and movers, as 'daily_aggs_websocket.update_daily_aggs_data' does.
+
+Run from the repository root: python -m benchmarks.journal_replay_benchmark <journal file>
+Without a journal file, a synthetic journal is written and replayed.
+"""
+
+
+def write_synthetic_journal(path: str, nsymbols: int, nminutes: int, frame_size: int) -> str:
+    writer = JournalWriter(path, compress=False)
+    received_at = int(timezone('US/Eastern').localize(datetime(2024, 1, 2, 10)).timestamp()) * 1_000_000_000
+    for frame in make_frames(make_symbols(nsymbols), nminutes, frame_size):
+        writer.write(json.dumps(frame), received_at)
+        received_at += 1_000_000
+    writer.close()
+    return os.path.join(path, os.listdir(path)[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a websocket journal through the live aggregates.')
+    parser.add_argument('journal', nargs='?', help='journal file, a synthetic one is replayed if not given')
+    parser.add_argument('--symbols', type=int, default=10000, help='symbols of the synthetic journal')
+    parser.add_argument('--minutes', type=int, default=10, help='minutes of the synthetic journal')
+    parser.add_argument('--frame-size', type=int, default=1000, help='messages per frame of the synthetic journal')
+    args = parser.parse_args()
+
+    journal = args.journal
+    if journal is None:
+        journal = write_synthetic_journal(tempfile.mkdtemp(), args.symbols, args.minutes, args.frame_size)
+
+    # Decode the journal first, so reading it is not measured.
+    start = time.perf_counter()
+    frames = [(received_at, frame) for received_at, frame in read_frames(journal)]
+    read_seconds = time.perf_counter() - start
+
+    eastern = timezone('US/Eastern')
+    live_aggs = LiveAggregates(minute_bars=MinuteBarBuffer(60), movers=MoversIndex(50))
+    decode_seconds = update_seconds = 0
+    nmessages = 0
+    for received_at, frame in frames:
+        start = time.perf_counter()
+        received = json.loads(frame)
+        decode_seconds += time.perf_counter() - start
+
+        if not received or received[0].get('ev') != 'AM':
+            continue
+        nmessages += len(received)
+        current_datetime = datetime.fromtimestamp(received_at / 1e9, eastern)
+
+        start = time.perf_counter()
+        live_aggs.update(received, False, current_datetime.time())
+        live_aggs.publish(current_datetime)
+        update_seconds += time.perf_counter() - start
+
+    print(f'{journal}: {len(frames)} frames, {nmessages} messages (read in {read_seconds:.2f}s)')
+    print(f'decode: {decode_seconds:.2f}s, {nmessages / decode_seconds:,.0f} messages/s')
+    print(f'update and publish: {update_seconds:.2f}s, {nmessages / update_seconds:,.0f} messages/s')
+    print(f'total: {nmessages / (decode_seconds + update_seconds):,.0f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import random
+import string
+import time
+from datetime import time as time_
+from typing import Any, Dict, List
+
+from data.live_aggs import LiveAggregates
+
+"""
+Messages per second benchmark of the live aggregates of the 'AM' websocket.
+
+Replays synthetic minutes of 'AM.*' messages, one batch per websocket frame, through 'LiveAggregates.update' (and
+the snapshot published after every frame) and through the dict of dicts it replaced.
+
+Run from the repository root: python -m benchmarks.live_aggs_benchmark
+"""
+
+
+def make_symbols(nsymbols: int) -> List[str]:
+    rng = random.Random(0)
+    symbols = set()
+    while len(symbols) < nsymbols:
+        symbols.add(''.join(rng.choices(string.ascii_uppercase, k=rng.randint(1, 5))))
+    # Some non alphabetical symbols the websocket also receives.
+    return sorted(symbols) + [f'{symbol}.WS' for symbol in list(symbols)[:nsymbols // 50]]
+
+
+def make_frames(symbols: List[str], nminutes: int, frame_size: int) -> List[List[Dict[str, Any]]]:
+    rng = random.Random(1)
+    frames = []
+    for minute in range(nminutes):
+        messages = []
+        for symbol in symbols:
+            open_ = rng.uniform(1, 500)
+            messages.append({'ev': 'AM', 'sym': symbol, 'v': rng.randint(1, 100000), 'av': 0, 'op': open_,
+                             'vw': open_, 'o': open_, 'c': open_ * rng.uniform(0.99, 1.01),
+                             'h': open_ * 1.01, 'l': open_ * 0.99, 'a': open_, 'z': 100,
+                             's': minute * 60000, 'e': (minute + 1) * 60000})
+        frames.extend(messages[i:i + frame_size] for i in range(0, len(messages), frame_size))
+    return frames
+
+
+def legacy_update(daily_aggs_data: Dict[str, Dict[str, float]], new_aggs_data: List[Dict[str, Any]],
+                  current_time: time_):
+    """The per message dict of dicts update 'LiveAggregates' replaced."""
+    for symbol_data in new_aggs_data:
+        symbol = symbol_data['sym']
+        if not (symbol.isalpha() and symbol.isupper()):
+            continue
+        if symbol not in daily_aggs_data:
+            daily_aggs_data[symbol] = dict()
+        daily_aggs_data[symbol]['volume'] = daily_aggs_data[symbol].get('volume', 0) + symbol_data['v']
+        if not (time_(9, 30) <= current_time <= time_(16)):
+            continue
+        if 'open' not in daily_aggs_data[symbol]:
+            daily_aggs_data[symbol]['open'] = round(symbol_data['o'], 3)
+            daily_aggs_data[symbol]['high'] = round(symbol_data['h'], 3)
+            daily_aggs_data[symbol]['low'] = round(symbol_data['l'], 3)
+        if symbol_data['h'] > daily_aggs_data[symbol]['high']:
+            daily_aggs_data[symbol]['high'] = round(symbol_data['h'], 3)
+        if symbol_data['l'] < daily_aggs_data[symbol]['low']:
+            daily_aggs_data[symbol]['low'] = round(symbol_data['l'], 3)
+        daily_aggs_data[symbol]['close'] = round(symbol_data['c'], 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Messages per second benchmark of the live aggregates.')
+    parser.add_argument('--symbols', type=int, default=10000)
+    parser.add_argument('--minutes', type=int, default=10)
+    parser.add_argument('--frame-size', type=int, default=1000, help='messages per websocket frame')
+    args = parser.parse_args()
+
+    frames = make_frames(make_symbols(args.symbols), args.minutes, args.frame_size)
+    nmessages = sum(len(frame) for frame in frames)
+    current_time = time_(10)
+
+    live_aggs = LiveAggregates()
+    start = time.perf_counter()
+    for frame in frames:
+        live_aggs.update(frame, False, current_time)
+        live_aggs.publish(None)
+    live_aggs_seconds = time.perf_counter() - start
+
+    daily_aggs_data = dict()
+    start = time.perf_counter()
+    for frame in frames:
+        legacy_update(daily_aggs_data, frame, current_time)
+    legacy_seconds = time.perf_counter() - start
+
+    print(f'{nmessages} messages in {len(frames)} frames')
+    print(f'LiveAggregates: {nmessages / live_aggs_seconds:,.0f} messages/s')
+    print(f'dict of dicts:  {nmessages / legacy_seconds:,.0f} messages/s '
+          f'(the websocket also read the clock several times per message)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import json
+import time
+from datetime import time as time_
+from typing import List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from benchmarks.live_aggs_benchmark import make_frames, make_symbols
+from data.live_aggs import LiveAggregates
+from data.minute_bars import MinuteBarBuffer
+from data.movers import MoversIndex
+from data.ws_journal import read_frames
+
+"""
+Local stand-in for Polygon.io's stocks websocket, for load testing the ingestion of 'AM' bars.
+
+The server speaks Polygon.io's auth and subscribe protocol and replays the frames of a websocket journal, or
+synthetic minutes of 'AM' frames, at multiples of real time. Like Polygon.io, it drops frames for a client that falls
+more than '--max-lag' seconds behind.
+
+By default, a client folding the frames into live aggregates, as the websocket thread does, is run against the server
+at every '--speeds' multiple, and the client's lag behind the replay, the dropped frames and the processing cost per
+message are reported.
+
+Run from the repository root: python -m benchmarks.polygon_ws_stand_in [--journal <journal file>]
+With '--serve', the server replays to any client instead, e.g. Midas with 'polygon_websocket.url' set to
+'ws://127.0.0.1:8765/stocks'.
+"""
+
+BURST_SECONDS = 2  # Seconds the synthetic frames of a minute are sent over, at the start of the minute.
+
+
+def load_frames(journal: Optional[str], nsymbols: int, nminutes: int, frame_size: int) -> List[Tuple[float, str]]:
+    """Returns the frames to replay and their offsets, in seconds, from the start of the replay."""
+    if journal:
+        frames = [(received_at, frame.decode()) for received_at, frame in read_frames(journal)]
+        start = frames[0][0] if frames else 0
+        return [((received_at - start) / 1e9, frame) for received_at, frame in frames]
+
+    frames = []
+    minutes_frames = make_frames(make_symbols(nsymbols), nminutes, frame_size)
+    frames_per_minute = len(minutes_frames) // nminutes
+    for i, frame in enumerate(minutes_frames):
+        minute, j = divmod(i, frames_per_minute)
+        frames.append((minute * 60 + j * BURST_SECONDS / frames_per_minute, json.dumps(frame)))
+    return frames
+
+
+class ReplayServer:
+    """
+    Replays 'frames' to every client that authenticates and subscribes, at 'speed' times real time.
+
+    Parameters
+    ----------
+    mark : bool
+        Whether to append a '{"ev": "bench", "scheduled_at": <ns>}' message to every frame, for the benchmark client
+        to measure its lag with. Polygon.io clients do not expect it.
+
+    """
+    def __init__(self, frames: List[Tuple[float, str]], speed: float, max_lag: float, mark: bool):
+        self.frames = frames
+        self.speed = speed
+        self.max_lag = max_lag
+        self.mark = mark
+        self.sent = 0
+        self.dropped = 0
+        self.done = asyncio.Event()
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps([{'ev': 'status', 'status': 'connected', 'message': 'Connected Successfully'}]))
+
+        subscribed = False
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+            action = json.loads(message.data)
+            if action.get('action') == 'auth':
+                await ws.send_str(json.dumps([{'ev': 'status', 'status': 'auth_success',
+                                               'message': 'authenticated'}]))
+            elif action.get('action') in ('subscribe', 'unsubscribe'):
+                await ws.send_str(json.dumps([{'ev': 'status', 'status': 'success',
+                                               'message': f'{action["action"]}d to: {action.get("params")}'}]))
+                if action['action'] == 'subscribe' and not subscribed:
+                    subscribed = True
+                    asyncio.create_task(self.replay(ws))
+        return ws
+
+    async def replay(self, ws: web.WebSocketResponse):
+        start = time.monotonic()
+        for offset, frame in self.frames:
+            if ws.closed:
+                break
+            scheduled_at = start + offset / self.speed
+            if (delay := scheduled_at - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            elif -delay > self.max_lag:
+                self.dropped += 1
+                continue
+
+            if self.mark:
+                frame = f'{frame[:-1]},{{"ev":"bench","scheduled_at":{int(scheduled_at * 1e9)}}}]'
+            await ws.send_str(frame)
+            self.sent += 1
+
+        self.done.set()
+        await ws.close()
+
+
+async def run_client(url: str) -> dict:
+    """Folds the replayed frames into live aggregates, as the websocket thread does, and measures its lag."""
+    live_aggs = LiveAggregates(minute_bars=MinuteBarBuffer(60), movers=MoversIndex(50))
+    lags, nmessages, processing_seconds = [], 0, 0.0
+    # Replayed as if the market is open, so every bar updates the candles.
+    market_time = time_(10)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url) as ws:
+            await ws.send_json({'action': 'auth', 'params': ''})
+            await ws.send_json({'action': 'subscribe', 'params': 'AM.*'})
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+
+                start = time.perf_counter()
+                received = json.loads(message.data)
+                if received and received[-1].get('ev') == 'bench':
+                    scheduled_at = received.pop()['scheduled_at']
+                    if received and received[0].get('ev') == 'AM':
+                        live_aggs.update(received, False, market_time)
+                        live_aggs.publish(None)
+                        nmessages += len(received)
+                    lags.append(time.monotonic() - scheduled_at / 1e9)
+                processing_seconds += time.perf_counter() - start
+
+    return {'messages': nmessages, 'seconds': processing_seconds, 'lags': np.array(lags)}
+
+
+async def benchmark(frames: List[Tuple[float, str]], speed: float, max_lag: float, port: int):
+    server = ReplayServer(frames, speed, max_lag, mark=True)
+    app = web.Application()
+    app.router.add_get('/stocks', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    try:
+        result = await run_client(f'http://127.0.0.1:{port}/stocks')
+    finally:
+        await runner.cleanup()
+
+    lags = result['lags'] if len(result['lags']) else np.zeros(1)
+    print(f'{speed:>6g}x: sent {server.sent}, dropped {server.dropped} frames | '
+          f'{result["messages"] / max(result["seconds"], 1e-9):,.0f} messages/s, '
+          f'{result["seconds"] / max(result["messages"], 1) * 1e6:.2f} us/message | '
+          f'lag p50 {np.percentile(lags, 50) * 1e3:.1f} ms, p99 {np.percentile(lags, 99) * 1e3:.1f} ms, '
+          f'max {lags.max() * 1e3:.1f} ms')
+
+
+async def serve(frames: List[Tuple[float, str]], speed: float, max_lag: float, port: int):
+    server = ReplayServer(frames, speed, max_lag, mark=False)
+    app = web.Application()
+    app.router.add_get('/stocks', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    print(f'Replaying {len(frames)} frames at {speed:g}x on ws://127.0.0.1:{port}/stocks')
+    await server.done.wait()
+    print(f'Sent {server.sent}, dropped {server.dropped} frames')
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Polygon.io stocks websocket.')
+    parser.add_argument('--journal', help='websocket journal to replay, synthetic frames are replayed if not given')
+    parser.add_argument('--symbols', type=int, default=10000, help='symbols of the synthetic frames')
+    parser.add_argument('--minutes', type=int, default=5, help='minutes of synthetic frames')
+    parser.add_argument('--frame-size', type=int, default=1000, help='messages per synthetic frame')
+    parser.add_argument('--speeds', type=float, nargs='+', default=[1, 10, 30, 60],
+                        help='multiples of real time to replay at')
+    parser.add_argument('--max-lag', type=float, default=5, help='seconds behind after which frames are dropped')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--serve', action='store_true', help='only serve, at the first speed, to any client')
+    args = parser.parse_args()
+
+    frames = load_frames(args.journal, args.symbols, args.minutes, args.frame_size)
+    if args.serve:
+        asyncio.run(serve(frames, args.speeds[0], args.max_lag, args.port))
+        return
+
+    print(f'{len(frames)} frames over {frames[-1][0] if frames else 0:.0f}s of real time')
+    for speed in args.speeds:
+        asyncio.run(benchmark(frames, speed, args.max_lag, args.port))
+
+
+if __name__ == '__main__':
+    main()
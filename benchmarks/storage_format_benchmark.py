@@ -0,0 +1,112 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+from typing import Callable, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.live_aggs_benchmark import make_symbols
+from data import storage_format
+from data.snapshot_store import SnapshotStore
+
+"""
+Size and read time benchmark of the storage formats of the market snapshot files.
+
+Writes the same days of market snapshots in version 1 (float64 prices, object symbols, uncompressed) and in the
+current version uncompressed, zstd and lz4 compressed, and reports their size on disk, the time to read them with
+'pd.read_feather', 'storage_format.read_dataframe' and through the snapshot store, and the bytes the store holds.
+
+Run from the repository root: python -m benchmarks.storage_format_benchmark [--snapshots <snapshots directory>]
+Without a snapshots directory, synthetic snapshots are written.
+"""
+
+
+def make_snapshots(nsymbols: int, ndays: int) -> List[pd.DataFrame]:
+    rng = np.random.default_rng(0)
+    symbols = make_symbols(nsymbols)
+    closes = np.round(rng.lognormal(3, 1.5, len(symbols)), 2)
+    snapshots = []
+    for _ in range(ndays):
+        closes = np.round(closes * rng.uniform(0.95, 1.05, len(symbols)), 4)
+        snapshots.append(pd.DataFrame({
+            'T': symbols, 'open': np.round(closes * rng.uniform(0.98, 1.02, len(symbols)), 4),
+            'high': np.round(closes * 1.03, 4), 'low': np.round(closes * 0.97, 4), 'close': closes,
+            'volume': rng.integers(100, 10_000_000, len(symbols)), 'vwap': np.round(closes * 1.001, 4),
+            'trades': pd.array(rng.integers(1, 100_000, len(symbols)), dtype='Int64')}))
+    return snapshots
+
+
+def write_version_1(df: pd.DataFrame, path: str):
+    df.to_feather(path, compression='uncompressed')
+
+
+def time_reads(paths: List[str], read: Callable[[str], object], repeat: int) -> float:
+    """Returns the best of 'repeat' times to read every file of 'paths'."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            read(path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_store(snapshots_path: str, days: List[date], repeat: int) -> Tuple[float, int]:
+    """Returns the best of 'repeat' times to open every day of 'days' in a new snapshot store, and its bytes."""
+    best, nbytes = np.inf, 0
+    for _ in range(repeat):
+        store = SnapshotStore(snapshots_path, max_bytes=2 ** 62)
+        start = time.perf_counter()
+        for day in days:
+            store.get_dataframe(day, ['open', 'high', 'low', 'close', 'volume'])
+        best = min(best, time.perf_counter() - start)
+        nbytes = store.get_nbytes()
+    return best, nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the size and read time of the snapshot storage formats.')
+    parser.add_argument('--snapshots', help='directory of snapshots to compare, synthetic ones are written if not given')
+    parser.add_argument('--symbols', type=int, default=12000, help='symbols of the synthetic snapshots')
+    parser.add_argument('--days', type=int, default=20, help='days of synthetic snapshots')
+    parser.add_argument('--repeat', type=int, default=3, help='best of how many reads is reported')
+    args = parser.parse_args()
+
+    if args.snapshots:
+        files = sorted(file for file in os.listdir(args.snapshots) if file.endswith('.feather'))[-args.days:]
+        snapshots = [storage_format.read_dataframe(os.path.join(args.snapshots, file)) for file in files]
+    else:
+        snapshots = make_snapshots(args.symbols, args.days)
+    days = [date.fromordinal(date(2000, 1, 1).toordinal() + i) for i in range(len(snapshots))]
+
+    root = tempfile.mkdtemp()
+    formats = {'v1': write_version_1,
+               **{f'v{storage_format.FORMAT_VERSION} {compression}':
+                  lambda df, path, compression=compression: storage_format.write(df, path, compression)
+                  for compression in ['uncompressed', 'zstd', 'lz4']}}
+    try:
+        print(f'{len(snapshots)} snapshots of {len(snapshots[0])} symbols')
+        print(f'{"format":<18}{"MB":>8}{"read_feather s":>16}{"read_dataframe s":>18}{"store s":>10}{"store MB":>10}')
+        for name, write in formats.items():
+            snapshots_path = os.path.join(root, name.replace(' ', '_'))
+            os.makedirs(snapshots_path)
+            paths = [os.path.join(snapshots_path, f'{day}.feather') for day in days]
+            for df, path in zip(snapshots, paths):
+                write(df, path)
+
+            size = sum(os.path.getsize(path) for path in paths)
+            read_feather_seconds = time_reads(paths, pd.read_feather, args.repeat)
+            read_dataframe_seconds = time_reads(paths, storage_format.read_dataframe, args.repeat)
+            store_seconds, store_nbytes = time_store(snapshots_path, days, args.repeat)
+            print(f'{name:<18}{size / 1e6:>8.2f}{read_feather_seconds:>16.3f}{read_dataframe_seconds:>18.3f}'
+                  f'{store_seconds:>10.3f}{store_nbytes / 1e6:>10.2f}')
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ import strategy_runner
 from color import color
 from commands import command_manager
 from commands.Command import Command
-from data import market_data
+from data import market_data, storage_format, backfill as data_backfill
 from files.config import Config
 from strategies import strategy_list
 from strategies.strategy_list import strategies
@@ -58,6 +58,15 @@ def initialize_commands():
     command_manager.add_command(
         Command(name='midas-pl', desc='Gets the pls of Midas', func=midas_pl, usage='midas-pl')
     )
+    command_manager.add_command(
+        Command(name='backfill', desc='Downloads years of market snapshots and stock bars. Resumes if interrupted.', func=backfill, usage='backfill <years> <symbol:timeframe:multiplier>...')
+    )
+    command_manager.add_command(
+        Command(name='materialize-splits', desc='Writes a split adjusted copy of all historical data', func=materialize_splits, usage='materialize-splits <destination directory>')
+    )
+    command_manager.add_command(
+        Command(name='migrate-storage', desc='Rewrites historical data in the current storage format', func=migrate_storage, usage='migrate-storage')
+    )
 
     return command_manager
 
@@ -170,4 +179,26 @@ def midas_pl():
     pl = {str(day): round(pl, 2) for day, pl in portfolio_manager.get_midas_pl(False).items()}
     cum_pl = {day: round(pl, 2) for day, pl in zip(pl, np.cumsum(list(pl.values())))}
     print(f'Raw Daily PL: {pl}')
-    print(f'Raw Cumulative PL: {cum_pl}')
\ No newline at end of file
+    print(f'Raw Cumulative PL: {cum_pl}')
+
+
+def materialize_splits(dest_path: str):
+    cli_util.output(color.CYAN + f'Writing split adjusted data to {dest_path!r}')
+    nfiles = market_data.materialize_split_adjusted_data(dest_path)
+    cli_util.output(color.GREEN + f'Wrote {nfiles} split adjusted files to {dest_path!r}')
+
+
+def migrate_storage():
+    cli_util.output(color.CYAN + f'Migrating historical data to storage format {storage_format.FORMAT_VERSION}')
+    stats = storage_format.migrate(market_data.data_folder)
+    cli_util.output(color.GREEN + f'Migrated {stats["migrated"]} files, skipped {stats["skipped"]}: '
+                                  f'{stats["bytes_before"] / 1e6:,.1f} MB -> {stats["bytes_after"] / 1e6:,.1f} MB')
+
+
+def backfill(years: str, *stocks: str):
+    stocks_ = [(symbol, timeframe, int(multiplier)) for symbol, timeframe, multiplier in
+               [stock.split(':') for stock in stocks]]
+
+    cli_util.output(color.CYAN + f'Backfilling {years} years of market snapshots' + (f' and {", ".join(stocks)}' if stocks else ''))
+    stats = data_backfill.backfill(market_data.data_folder, float(years), stocks_, market_data.split_adjustments)
+    cli_util.output(color.GREEN + f'Backfilled {stats["days"]} days in {stats["seconds"]:.1f}s ({stats["days_per_second"]:.2f} days/s)')
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import os
+import time
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from color import color
+from data import historical_downloader
+from data.historical_downloader import DownloadJob
+from data.split_adjustments import SplitAdjustments
+from files.config import Config
+from logger import log
+from utils import t_util, cli_util, r_util
+
+"""
+Bulk backfill of market snapshots and per-symbol bars from Polygon.io.
+
+Progress is checkpointed to 'data/backfill_checkpoint.json' as jobs finish, so an interrupted backfill resumes where
+it stopped when it is run again. Jobs that wrote no rows are not checkpointed, since Polygon.io sometimes responds
+without results transiently, and are retried on the next run, unless they cover no market day. Bars are requested
+per calendar month or year, so the chunks, and their checkpoints, are the same whichever day a backfill is resumed on.
+
+The data is stored unadjusted, so the splits executed in the backfilled range are recorded too, and the data is
+adjusted for them when it is read.
+"""
+
+# Calendar periods of bars requested per request, keeping each response under Polygon.io's 50000 bar limit.
+CHUNK_PERIODS = {'minute': 'month', 'hour': 'year'}
+
+CHECKPOINT_INTERVAL = 5  # Seconds between checkpoint writes.
+
+
+def backfill(data_folder: str, years: float, stocks: List[Tuple[str, str, int]],
+             split_adjustments: Optional[SplitAdjustments] = None) -> Dict[str, float]:
+    """
+    Downloads 'years' of market snapshots and of the bars of 'stocks' that are not downloaded yet.
+
+    Parameters
+    ----------
+    data_folder : str
+        Midas data directory holding 'snapshots' and 'stocks'.
+    years : float
+        Number of years to backfill, up to yesterday.
+    stocks : List[Tuple[str, str, int]]
+        (symbol, timeframe, multiplier) of the bars to backfill, e.g. ('AAPL', 'minute', 1).
+    split_adjustments : Optional[SplitAdjustments]
+        Table the splits executed since the start of the backfill are recorded in.
+
+    Returns
+    -------
+    Dict[str, float]
+        'days', 'seconds' and 'days_per_second' of the run.
+
+    """
+    end = t_util.get_yesterday()
+    start = end - timedelta(days=round(years * 365))
+    checkpoint_path = os.path.join(data_folder, 'backfill_checkpoint.json')
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    if split_adjustments is not None:
+        nsplits = record_splits(split_adjustments, start, t_util.get_today())
+        log('market_data/backfill', f'Recorded {nsplits} new splits executed since {start}')
+
+    # Get the jobs that are not done yet.
+    jobs_days: Dict[str, Tuple[DownloadJob, int]] = dict()
+
+    snapshots_path = os.path.join(data_folder, 'snapshots')
+    existing_snapshot_dates = historical_downloader.get_snapshot_dates(snapshots_path)
+    for day in t_util.get_market_dates(start, end):
+        if day not in existing_snapshot_dates and (key := f'snapshot:{day}') not in checkpoint:
+            jobs_days[key] = (historical_downloader.market_snapshot_job(day, snapshots_path), 1)
+
+    for symbol, timeframe, multiplier in stocks:
+        for chunk_start, chunk_end in get_chunks(start, end, CHUNK_PERIODS.get(timeframe, 'year')):
+            if (key := f'stock:{symbol}:{timeframe}:{multiplier}:{chunk_start}:{chunk_end}') not in checkpoint:
+                job = historical_downloader.stock_data_job(symbol, timeframe, multiplier, chunk_start, chunk_end,
+                                                           os.path.join(data_folder, 'stocks'))
+                jobs_days[key] = (job, len(t_util.get_market_dates(chunk_start, chunk_end)))
+
+    if not jobs_days:
+        return {'days': 0, 'seconds': 0, 'days_per_second': 0}
+
+    keys = {job: key for key, (job, _) in jobs_days.items()}
+    ndays = sum(days for _, days in jobs_days.values())
+    progress = {'days': 0, 'last_checkpoint': time.monotonic()}
+    start_time = time.monotonic()
+
+    def on_done(job: DownloadJob, nrows: int):
+        key = keys[job]
+        # An empty response is only known to be final when the job has no market day to return bars of.
+        if nrows or not jobs_days[key][1]:
+            checkpoint[key] = nrows
+        progress['days'] += jobs_days[key][1]
+
+        if time.monotonic() - progress['last_checkpoint'] >= CHECKPOINT_INTERVAL:
+            save_checkpoint(checkpoint_path, checkpoint)
+            progress['last_checkpoint'] = time.monotonic()
+            seconds = time.monotonic() - start_time
+            cli_util.output(color.CYAN + f'Backfilled {progress["days"]}/{ndays} days '
+                                         f'({progress["days"] / seconds:.2f} days/s)')
+
+    try:
+        asyncio.run(historical_downloader.download([job for job, _ in jobs_days.values()], on_done=on_done))
+    finally:
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    seconds = time.monotonic() - start_time
+    stats = {'days': progress['days'], 'seconds': seconds, 'days_per_second': progress['days'] / seconds}
+    log('market_data/backfill', f'Backfilled {years} years of snapshots and {stocks}: {stats}')
+    return stats
+
+
+def get_chunks(start: date, end: date, period: str) -> List[Tuple[date, date]]:
+    """
+    Splits the calendar 'period's, 'month' or 'year', from the one holding 'start' to 'end' into ranges. Only the last
+    range is cut short, at 'end'.
+    """
+    chunks = []
+    chunk_start = start.replace(day=1) if period == 'month' else start.replace(month=1, day=1)
+    while chunk_start <= end:
+        if period == 'month':
+            next_chunk_start = date(chunk_start.year + chunk_start.month // 12, chunk_start.month % 12 + 1, 1)
+        else:
+            next_chunk_start = chunk_start.replace(year=chunk_start.year + 1)
+        chunks.append((chunk_start, min(next_chunk_start - timedelta(days=1), end)))
+        chunk_start = next_chunk_start
+    return chunks
+
+
+def record_splits(split_adjustments: SplitAdjustments, start: date, end: date) -> int:
+    """Records the splits executed from 'start' to 'end' in 'split_adjustments'. Returns the number of new splits."""
+    url = f'https://api.polygon.io/v3/reference/splits?execution_date.gte={start}&execution_date.lte={end}&limit=1000'
+    nsplits = 0
+    while url:
+        response = r_util.send_request(method='GET', url=f'{url}&apiKey={Config.get("polygon_api_key")}',
+                                       accept_bad_response=False).json()
+        nsplits += split_adjustments.add(response.get('results', []))
+        # Further pages, if any.
+        url = response.get('next_url')
+    return nsplits
+
+
+def load_checkpoint(path: str) -> Dict[str, int]:
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, int]):
+    # Write to a temporary file first so an interrupted write never corrupts the checkpoint.
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(f'{path}.tmp', path)
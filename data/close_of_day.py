@@ -0,0 +1,88 @@
+import json
+import os
+from datetime import date, datetime
+from threading import Lock
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from data import historical_downloader, storage_format
+from data.live_aggs import LiveSnapshot
+from data.snapshot_store import SnapshotStore
+from files.config import Config
+
+"""
+Writes the day's live aggregates to the snapshot store at the close, so the next market day does not download the
+day's grouped daily aggs, and reconciles them with Polygon.io's grouped daily aggs later.
+
+Snapshots written from the live aggregates are provisional until they are reconciled, and are listed in
+'provisional_snapshots.json' next to the snapshots directory.
+"""
+
+_lock = Lock()
+
+
+def get_provisional_path(snapshot_store: SnapshotStore) -> str:
+    return os.path.join(os.path.dirname(snapshot_store.snapshots_path), 'provisional_snapshots.json')
+
+
+def get_provisional_days(snapshot_store: SnapshotStore) -> List[date]:
+    if not os.path.isfile(path := get_provisional_path(snapshot_store)):
+        return []
+    with open(path, 'r') as file:
+        return [datetime.strptime(day, '%Y-%m-%d').date() for day in json.load(file)]
+
+
+def set_provisional(snapshot_store: SnapshotStore, day: date, provisional: bool):
+    with _lock:
+        days = set(get_provisional_days(snapshot_store))
+        days = days | {day} if provisional else days - {day}
+        with open(get_provisional_path(snapshot_store), 'w') as file:
+            json.dump(sorted(str(day_) for day_ in days), file)
+
+
+def write_live_snapshot(snapshot_store: SnapshotStore, live_snapshot: LiveSnapshot, day: date) -> int:
+    """
+    Writes 'live_snapshot' as the provisional snapshot of 'day'. Returns the number of symbols written.
+
+    Notes
+    -----
+    Only symbols with a close, i.e. that traded during market hours, are written.
+
+    """
+    market_snapshot = live_snapshot.to_dataframe()
+    market_snapshot = market_snapshot[~np.isnan(market_snapshot['close'].to_numpy())].reset_index()
+    market_snapshot = market_snapshot.astype({'trades': 'Int64'})
+
+    historical_downloader.write_market_snapshot(market_snapshot, snapshot_store.get_path(day),
+                                                Config.get('storage.snapshot_compression', 'uncompressed'))
+    snapshot_store.evict(day)
+    set_provisional(snapshot_store, day, True)
+    return len(market_snapshot)
+
+
+async def reconcile(snapshot_store: SnapshotStore, day: date) -> Optional[Dict[str, int]]:
+    """
+    Replaces the provisional snapshot of 'day' with Polygon.io's grouped daily aggs, and returns how they differ.
+    Returns 'None', and leaves the snapshot provisional, if Polygon.io has no grouped daily aggs for 'day' yet.
+    """
+    path = snapshot_store.get_path(day)
+    live = storage_format.read_dataframe(path).set_index('T') if os.path.isfile(path) else \
+        pd.DataFrame(columns=['close', 'volume'])
+
+    job = historical_downloader.market_snapshot_job(day, snapshot_store.snapshots_path)
+    if not (await historical_downloader.download([job]))[0]:
+        return None
+    snapshot_store.evict(day)
+    set_provisional(snapshot_store, day, False)
+
+    polygon = storage_format.read_dataframe(path).set_index('T')
+    symbols = live.index.intersection(polygon.index)
+    return {'symbols': len(polygon),
+            'missing': len(polygon.index.difference(live.index)),
+            'extra': len(live.index.difference(polygon.index)),
+            'close_mismatches': int((~np.isclose(live.loc[symbols, 'close'], polygon.loc[symbols, 'close'],
+                                                 rtol=1e-3)).sum()),
+            'volume_mismatches': int((~np.isclose(live.loc[symbols, 'volume'], polygon.loc[symbols, 'volume'],
+                                                  rtol=1e-2)).sum())}
@@ -1,146 +1,325 @@
+import asyncio
 import json
+import os
+import random
 import time
 import traceback
-from datetime import datetime
-from typing import Dict, Any, List, Union
+from datetime import date, datetime
+from threading import Event
+from typing import Dict, Any, List, Optional
 
-import requests
-import websocket
+import aiohttp
 
 import main
 from color import color
+from data import historical_downloader, subscription_manager
+from data.live_aggs import LiveAggregates, MinuteCompletion
+from data.minute_bars import MinuteBarBuffer
+from data.movers import MoversIndex
+from data.ws_journal import JournalWriter
+from files import MIDAS_PATH
 from files.config import Config
 from logger import log
 from utils import t_util, cli_util
 
-daily_aggs_data: Dict[str, Dict[str, Union[int, float]]] = dict()
-last_received_date = t_util.get_today()
-
+"""
+Keeps today's candle of every symbol up to date from Polygon.io's 'AM' (minute aggregates) websocket.
 
-def run():
-    ws = websocket.WebSocket()
+The websocket is read by an asyncio client that pings the server every 'polygon_websocket.heartbeat' seconds and
+reconnects with exponential backoff when the connection drops or handling a message fails. It only stops when Midas
+ends. After reconnecting, the minutes missed are filled in from the REST minute aggs of the symbols that were active
+before the drop, instead of reloading the whole market.
 
-    ws.connect("wss://socket.polygon.io/stocks")
+A session is only covered, so its live aggregates can stand in for Polygon.io's grouped daily aggs, if the websocket
+was connected by the open and every gap since was filled in from minute aggs.
+"""
 
-    ws.send(json.dumps({
-    "action": "auth",
-    "params": Config.get("polygon_api_key")
-    }))
+live_aggs = LiveAggregates(minute_bars=MinuteBarBuffer(), movers=MoversIndex())
+minute_completion = MinuteCompletion()
+last_received_date = t_util.get_today()
 
-    ws.send(json.dumps({
-    "action": "subscribe",
-    "params": f"{','.join(['AM.*'])}"
-    }))
+# Bars ending at or before this time, in milliseconds, were filled in from the REST API after a reconnect.
+gap_filled_until = 0
 
-    global last_received_date
-    global daily_aggs_data
+# Journal of the raw frames received, if 'polygon_websocket.journal' is enabled.
+journal: Optional[JournalWriter] = None
 
-    # log('market_data/daily_aggs_websocket', 'started')
-    while not main.end_midas.is_set():
-        x = ws.recv()
-        try:
-            received = json.loads(x)
+# Set once the bars of the day's last market minute are received, or 'polygon_websocket.close_grace' seconds after the
+# close if they are not, when the websocket closes until the next market open.
+session_closed = Event()
 
-            if received[0]['ev'] == 'AM':
-                # Reset daily candle on new day
-                if t_util.get_today() != last_received_date:
-                    daily_aggs_data = dict()
-                    last_received_date = t_util.get_today()
+# Day whose whole session was received, or filled in from minute aggs after reconnecting. Set when the websocket
+# connects by the open, and reset once a part of the session is only known from grouped daily aggs, e.g. after starting
+# late.
+covered_day: Optional[date] = None
 
-                # Update daily candle if in market times
-                update_daily_aggs_data(received, False)
+RECEIVE_TIMEOUT = 1  # Seconds between checks for Midas ending while no message is received.
 
-            # Market has closed, so close websocket until next market open
-            if t_util.get_current_time() > t_util.get_market_close_time():
-                time_until_next_market_open = datetime.combine(t_util.get_next_market_open_date(t_util.get_today()), datetime.min.time()) - t_util.get_current_datetime().replace(tzinfo=None)
-                log('market_data/daily_aggs_websocket', 'websocket thread sleeping')
-                time.sleep(time_until_next_market_open.seconds)
-                log('market_data/daily_aggs_websocket', 'websocket thread no longer sleeping')
 
-        except json.decoder.JSONDecodeError as e:
-            today_aggs = requests.get(f'https://api.polygon.io/v2/aggs/grouped/locale/us/market/stocks/{t_util.get_today()}?adjusted=false&include_otc=false&apiKey={Config.get("polygon_api_key")}').json()['results']
-            log('market_data/daily_aggs_websocket', f'error: {e}. Recieved: {received} Getting grouped daily aggs')
-            update_daily_aggs_data(today_aggs, True)
-            ws.close()
-            run()
+def load():
+    """Runs the websocket client until Midas ends. Target of the websocket thread."""
+    global journal
+    if Config.get('polygon_websocket.journal', False):
+        journal = JournalWriter(os.path.join(MIDAS_PATH, 'data', 'ws_journal'),
+                                Config.get('polygon_websocket.journal_compress', True))
 
-    ws.close()
+    try:
+        asyncio.run(run())
+    except Exception:
+        log('market_data/daily_aggs_websocket', f'error: {traceback.format_exc()}')
+        cli_util.output(color.WARNING + traceback.format_exc())
+    finally:
+        if journal is not None:
+            journal.close()
     cli_util.output(color.YELLOW + 'Websocket thread exited')
-    exit()
 
 
-def update_daily_aggs_data(new_aggs_data: List[Dict[str, Any]], daily_aggs: bool):
-    global daily_aggs_data
+async def run():
+    global covered_day
+    covered_day = None
 
-    for symbol_data in new_aggs_data:
-        symbol = symbol_data['sym' if not daily_aggs else 'T']
+    # Wait until new minute, then load grouped daily aggs to get 'missing' data for today.
+    while t_util.get_current_time().second != 0 and not main.end_midas.is_set():
+        await asyncio.sleep(1)
 
-        if not (symbol.isalpha() and symbol.isupper()):
-            continue
+    max_backoff = Config.get('polygon_websocket.max_backoff', 60)
+    attempt = 0
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
+        # Load any missed data today
+        try:
+            await load_today_aggs(session)
+        except Exception as e:
+            log('market_data/daily_aggs_websocket', f'Failed to load grouped daily aggs: {e!r}')
+
+        while not main.end_midas.is_set():
+            try:
+                async with session.ws_connect(Config.get('polygon_websocket.url', 'wss://socket.polygon.io/stocks'),
+                                              heartbeat=Config.get('polygon_websocket.heartbeat', 30)) as ws:
+                    await authenticate(ws)
+                    subscription_manager.reset()
+                    await update_subscription(ws)
+                    log('market_data/daily_aggs_websocket', 'connected')
+
+                    if attempt:
+                        await fill_gap(session)
+                    attempt = 0
+
+                    # Connected by the open, the websocket receives the whole session.
+                    if t_util.get_current_time() <= t_util.get_market_open_time():
+                        covered_day = t_util.get_today()
+
+                    await receive(ws)
+                    continue
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError, PermissionError) as e:
+                log('market_data/daily_aggs_websocket', f'connection lost: {e!r}')
+            # Any other error, e.g. in handling a message, drops the connection too rather than ending the thread.
+            except Exception:
+                log('market_data/daily_aggs_websocket', f'error: {traceback.format_exc()}')
+                cli_util.output(color.WARNING + traceback.format_exc())
+
+            if main.end_midas.is_set():
+                break
+
+            # Back off exponentially, with jitter, before reconnecting.
+            attempt += 1
+            delay = min(2 ** attempt, max_backoff) * (0.5 + random.random() / 2)
+            log('market_data/daily_aggs_websocket', f'reconnecting in {delay:.1f}s (attempt {attempt})')
+            await asyncio.sleep(delay)
+
+
+async def authenticate(ws: aiohttp.ClientWebSocketResponse):
+    """
+    Authenticates 'ws'. Raises if no status is received within 'polygon_websocket.auth_timeout' seconds or Midas ends
+    first, so the connection is dropped rather than waited on forever.
+    """
+    await ws.send_json({'action': 'auth', 'params': Config.get('polygon_api_key')})
+    deadline = time.monotonic() + Config.get('polygon_websocket.auth_timeout', 10)
+    while not main.end_midas.is_set():
+        if time.monotonic() > deadline:
+            raise asyncio.TimeoutError('no authentication status received')
+        for message in await receive_json(ws):
+            if message.get('ev') == 'status' and message.get('status') == 'auth_success':
+                return
+            if message.get('ev') == 'status' and message.get('status') == 'auth_failed':
+                raise PermissionError(message.get('message'))
+    raise ConnectionError('Midas ended before authenticating')
+
+
+async def receive_json(ws: aiohttp.ClientWebSocketResponse) -> List[Dict[str, Any]]:
+    """Returns the next message of 'ws', or an empty list if none is received within 'RECEIVE_TIMEOUT' seconds."""
+    try:
+        message = await ws.receive(timeout=RECEIVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return []
 
-        if 'otc' in symbol:
-            continue
+    if message.type == aiohttp.WSMsgType.TEXT:
+        if journal is not None:
+            journal.write(message.data)
+        try:
+            return json.loads(message.data)
+        except json.decoder.JSONDecodeError as e:
+            # A malformed frame only loses its own bars, so it is skipped rather than reconnecting.
+            log('market_data/daily_aggs_websocket', f'error: {e}. Received: {message.data[:1000]}')
+            return []
 
-        if symbol not in daily_aggs_data:
-            daily_aggs_data[symbol] = dict()
+    if message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED,
+                        aiohttp.WSMsgType.ERROR):
+        raise ConnectionError(f'websocket closed: {message.type.name} {message.data or ws.exception()}')
+    return []
 
-        if not daily_aggs:
-            daily_aggs_data[symbol]['volume'] = daily_aggs_data[symbol].get('volume', 0) + symbol_data['v']
 
-        if not (t_util.get_market_open_time() <= t_util.get_current_time() <= t_util.get_market_close_time()):
-            continue
+async def receive(ws: aiohttp.ClientWebSocketResponse):
+    global gap_filled_until
 
-        if 'open' not in daily_aggs_data[symbol]:
-            daily_aggs_data[symbol]['open'] = round(symbol_data['o'], 3)
-            daily_aggs_data[symbol]['high'] = round(symbol_data['h'], 3)
-            daily_aggs_data[symbol]['low'] = round(symbol_data['l'], 3)
+    while not main.end_midas.is_set():
+        await update_subscription(ws)
+        received = await receive_json(ws)
+
+        if received and received[0].get('ev') == 'AM':
+            # Reset daily candle on new day
+            reset_on_new_day()
+
+            # Skip the bars that were already filled in after reconnecting.
+            if gap_filled_until:
+                if received[0]['e'] <= gap_filled_until:
+                    received = [symbol_data for symbol_data in received if symbol_data['e'] > gap_filled_until]
+                else:
+                    gap_filled_until = 0
+
+            # Update daily candle if in market times
+            update_daily_aggs_data(received, False)
+
+        # Market has closed, so close websocket until next market open, once the bars of the last minute are in.
+        if t_util.get_current_time() <= t_util.get_market_close_time():
+            session_closed.clear()
+        elif is_session_received():
+            session_closed.set()
+            await ws.close()
+            next_market_open = datetime.combine(t_util.get_next_market_open_date(t_util.get_today()),
+                                                datetime.min.time())
+            log('market_data/daily_aggs_websocket', 'websocket thread sleeping')
+            await sleep_until(next_market_open)
+            log('market_data/daily_aggs_websocket', 'websocket thread no longer sleeping')
+            return
+
+
+def get_session_close() -> datetime:
+    """Returns today's market close, which the bars of the last market minute end at."""
+    close_time = t_util.get_market_close_time()
+    return t_util.get_current_datetime().replace(hour=close_time.hour, minute=close_time.minute, second=0,
+                                                 microsecond=0)
+
+
+def is_session_received() -> bool:
+    """
+    Returns whether the bars of today's last market minute are received, or 'polygon_websocket.close_grace' seconds
+    passed since the close.
+    """
+    session_close = get_session_close()
+    if minute_completion.is_complete(session_close, Config.get('live_data.minute_quiet_period', 0.5),
+                                     Config.get('live_data.minute_expected_ratio', 0.95)):
+        return True
+    seconds_since_close = (t_util.get_current_datetime() - session_close).total_seconds()
+    return seconds_since_close >= Config.get('polygon_websocket.close_grace', 60)
+
+
+def is_session_covered() -> bool:
+    """Returns whether every bar of today's session was received, or filled in from minute aggs after reconnecting."""
+    return covered_day == t_util.get_today()
+
+
+async def update_subscription(ws: aiohttp.ClientWebSocketResponse):
+    """Sends the messages that bring the subscription to the universe of the subscription manager."""
+    for message in subscription_manager.get_changes():
+        await ws.send_json(message)
+
+
+async def sleep_until(until: datetime):
+    """Sleeps until 'until', in US/Eastern time, or until Midas ends."""
+    while not main.end_midas.is_set() and (remaining := (until - t_util.get_current_datetime().replace(tzinfo=None))
+                                           .total_seconds()) > 0:
+        await asyncio.sleep(min(remaining, RECEIVE_TIMEOUT))
+
+
+def reset_on_new_day():
+    global last_received_date
+    if t_util.get_today() != last_received_date:
+        live_aggs.reset()
+        minute_completion.reset()
+        last_received_date = t_util.get_today()
 
-        if symbol_data['h'] > daily_aggs_data[symbol]['high']:
-            daily_aggs_data[symbol]['high'] = round(symbol_data['h'], 3)
 
-        if symbol_data['l'] < daily_aggs_data[symbol]['low']:
-            daily_aggs_data[symbol]['low'] = round(symbol_data['l'], 3)
+def update_daily_aggs_data(new_aggs_data: List[Dict[str, Any]], daily_aggs: bool):
+    current_datetime = t_util.get_current_datetime()
+    live_aggs.update(new_aggs_data, daily_aggs, current_datetime.time(), int(get_session_close().timestamp()) * 1000)
+    live_aggs.publish(current_datetime)
 
-        daily_aggs_data[symbol]['close'] = round(symbol_data['c'], 3)
+    if not daily_aggs:
+        minute_completion.record([symbol_data['e'] for symbol_data in new_aggs_data])
 
 
-def load():
-    global daily_aggs_data
+async def fill_gap(session: aiohttp.ClientSession):
+    """
+    Fills in the minute bars missed while the websocket was disconnected, from the REST minute aggs of the symbols
+    that received bars in the last 'polygon_websocket.gap_fill_active_minutes' minutes before the disconnect.
 
-    try:
-        # Wait until new minute, then load grouped daily aggs to get 'missing' data for today.
-        while t_util.get_current_time().second != 0:
-            time.sleep(1)
+    Notes
+    -----
+    Falls back to reloading today's grouped daily aggs when more than 'polygon_websocket.gap_fill_max_symbols'
+    symbols were active, since the REST requests would then take longer than the reload. The session is no longer
+    covered then, nor when a request fails.
 
-        # Load any missed data today
-        load_today_aggs()
+    """
+    global gap_filled_until, covered_day
 
-        # Start websocket
-        run()
+    reset_on_new_day()
+    if not (last_bar_end := live_aggs.get_last_bar_end()):
+        # Without a bar to fill in from, the bars missed since the open are unknown.
+        if t_util.get_current_time() > t_util.get_market_open_time():
+            covered_day = None
+        return
 
-    except Exception:
-        log('market_data/daily_aggs_websocket', f'error: {traceback.format_exc()}. Rerunning')
-        cli_util.output(color.WARNING + traceback.format_exc())
-        daily_aggs_data = dict()
-        load()
+    # Bars of minutes that ended before the reconnect. The websocket sends the bars of the minutes ending after it.
+    gap_end = int(time.time()) // 60 * 60000
+    if gap_end <= last_bar_end:
+        return
 
+    active_minutes = Config.get('polygon_websocket.gap_fill_active_minutes', 15)
+    symbols = live_aggs.get_active_symbols(last_bar_end - active_minutes * 60000)
+    if len(symbols) > Config.get('polygon_websocket.gap_fill_max_symbols', 300):
+        log('market_data/daily_aggs_websocket', f'{len(symbols)} active symbols. Reloading grouped daily aggs')
+        covered_day = None
+        await load_today_aggs(session)
+        return
 
-def load_today_aggs():
-    today_aggs = requests.get(f'https://api.polygon.io/v2/aggs/grouped/locale/us/market/stocks/{t_util.get_today()}?adjusted=false&include_otc=false&apiKey={Config.get("polygon_api_key")}').json()
+    async def fetch_bars(symbol: str) -> List[Dict[str, Any]]:
+        url = f'https://api.polygon.io/v2/aggs/ticker/{symbol}/range/1/minute/{last_bar_end - 60000}/{gap_end}?adjusted=false&sort=asc&limit=50000&apiKey={Config.get("polygon_api_key")}'
+        response = json.loads(await historical_downloader.fetch(url, session))
+        # REST bars start at 't', the websocket's end at 'e'.
+        return [{'sym': symbol, 'o': bar['o'], 'h': bar['h'], 'l': bar['l'], 'c': bar['c'], 'v': bar['v'],
+                 'vw': bar.get('vw'), 'e': bar['t'] + 60000}
+                for bar in response.get('results', []) if last_bar_end < bar['t'] + 60000 <= gap_end]
+
+    results = await asyncio.gather(*[fetch_bars(symbol) for symbol in symbols], return_exceptions=True)
+    bars = [bar for result in results if not isinstance(result, BaseException) for bar in result]
+    nerrors = sum(isinstance(result, BaseException) for result in results)
+    if nerrors:
+        covered_day = None
+
+    # Ordered by end so each symbol's last bar sets its close.
+    bars.sort(key=lambda bar: bar['e'])
+    update_daily_aggs_data(bars, False)
+    gap_filled_until = gap_end
+    log('market_data/daily_aggs_websocket', f'Filled {len(bars)} bars of {len(symbols)} symbols from '
+                                            f'{last_bar_end} to {gap_end}. {nerrors} requests failed')
+
+
+async def load_today_aggs(session: aiohttp.ClientSession):
+    url = f'https://api.polygon.io/v2/aggs/grouped/locale/us/market/stocks/{t_util.get_today()}?adjusted=false&include_otc=false&apiKey={Config.get("polygon_api_key")}'
+    today_aggs = json.loads(await historical_downloader.fetch(url, session))
     if 'results' not in today_aggs:
         return
 
-    today_aggs = today_aggs['results']
-
-    for symbol_data in today_aggs:
-        symbol = symbol_data['T']
-        if not (symbol.isalpha() and symbol.isupper()):
-            continue
-
-        daily_aggs_data[symbol] = {
-            'open': round(symbol_data['o'], 3),
-            'high': round(symbol_data['h'], 3),
-            'low': round(symbol_data['l'], 3),
-            'close': round(symbol_data['c'], 3),
-            'volume': symbol_data['v']
-        }
+    live_aggs.set_daily_aggs(today_aggs['results'])
+    live_aggs.publish(t_util.get_current_datetime())
@@ -1,5 +1,35 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Any, Dict, Hashable, List, Tuple
+
+
+class DataRequestKey:
+    """
+    Immutable, interned key of a DataRequest.
+
+    Keys are interned when created, so equal keys are the same object, comparing them is an identity check and
+    their hash is only computed once.
+
+    """
+    __slots__ = ('fields', '_hash')
+    _interned: Dict[Tuple[Any, ...], 'DataRequestKey'] = dict()
+
+    def __new__(cls, *fields):
+        key = cls._interned.get(fields)
+        if key is None:
+            key = super().__new__(cls)
+            key.fields = fields
+            key._hash = hash(fields)
+            key = cls._interned.setdefault(fields, key)
+        return key
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, DataRequestKey) and self.fields == other.fields)
+
+    def __str__(self):
+        return str(self.fields)
 
 
 class DataRequest(ABC):
@@ -20,19 +50,61 @@ class DataRequest(ABC):
     round_to : int
         The decimal func returned data will be rounded to.
 
+    Attributes
+    ----------
+    merge_key : DataRequestKey
+        Identifies the data requests that can be merged into one. Built from 'get_merge_fields'.
+    key : DataRequestKey
+        Identifies the data request. Two data requests with the same key request the same data.
+    data_key : Hashable
+        Key of the data of the request in what 'market_data.get' returns when it gets several data requests at once.
+        Its merge key, so the data of different data requests never overwrite each other.
+
+    Notes
+    -----
+    'columns' is stored sorted and without duplicates, so the order columns are requested in does not matter.
+    Data requests must not be changed once created, since their keys are built when they are first used.
+
     """
     def __init__(self,
                  columns: List[str],
                  round_to: int):
-        self.columns = columns
+        self.columns = tuple(sorted(set(columns)))
         self.round_to = round_to
 
-    def __hash__(self):
-        return hash(str(self))
-
     @abstractmethod
-    def can_merge_with(self, data_request) -> bool:
+    def get_merge_fields(self) -> Tuple[Any, ...]:
+        """Returns the fields that must be equal for two data requests to be merged."""
         raise NotImplementedError
 
+    @property
+    def merge_key(self) -> DataRequestKey:
+        try:
+            return self._merge_key
+        except AttributeError:
+            self._merge_key = DataRequestKey(type(self).__name__, *self.get_merge_fields())
+            return self._merge_key
+
+    @property
+    def key(self) -> DataRequestKey:
+        try:
+            return self._key
+        except AttributeError:
+            self._key = DataRequestKey(self.merge_key, self.columns, self.round_to)
+            return self._key
+
+    @property
+    def data_key(self) -> Hashable:
+        return self.merge_key
+
+    def can_merge_with(self, data_request) -> bool:
+        return self.merge_key is data_request.merge_key
+
+    def __eq__(self, other):
+        return isinstance(other, DataRequest) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
     def __str__(self):
-        return str(self.__dict__)
+        return str({attr: value for attr, value in self.__dict__.items() if not attr.startswith('_')})
@@ -0,0 +1,42 @@
+from typing import Any, List, Optional, Tuple
+
+from data.data_requests.data_request import DataRequest
+
+
+class IntradayBarsRequest(DataRequest):
+    """
+    Requests today's last minute bars, served from the minute bars kept in memory from the 'AM' websocket.
+
+    Parameters
+    ----------
+    columns : List[str]
+        Any of 'open', 'high', 'low', 'close', 'volume' and 'vwap'.
+    lookback : int
+        Number of minute bars per symbol. At most 'live_data.minute_bars'.
+    symbols : optional, List[str]
+        Symbols to get bars of. Every symbol received if 'None'.
+
+    Methods
+    -------
+    __add__ : IntradayBarsRequest
+        Combines two IntradayBarsRequests with the same lookback and symbols into one requesting the columns of both.
+
+    Notes
+    -----
+    The data of the request is a DataFrame indexed by symbol ('T') and bar start ('t'), oldest bar first.
+
+    """
+    def __init__(self, columns: List[str],
+                 lookback: int,
+                 symbols: Optional[List[str]] = None,
+                 round_to: int = 3):
+        self.lookback = lookback
+        self.symbols = tuple(sorted(set(symbols))) if symbols is not None else None
+        super().__init__(columns, round_to)
+
+    def get_merge_fields(self) -> Tuple[Any, ...]:
+        return self.lookback, self.symbols
+
+    def __add__(self, other):
+        return IntradayBarsRequest(list(self.columns + other.columns), self.lookback, self.symbols,
+                                   max(self.round_to, other.round_to))
@@ -1,46 +1,60 @@
-from typing import List, Optional
+from typing import Any, Iterable, List, Optional, Tuple
 
+from data import snapshot_filters
 from data.data_requests.data_request import DataRequest
+from data.snapshot_filters import Filter
 
 
 class MarketSnapshotRequest(DataRequest):
     """
     Requests a MarketSnapshot from Polygon.io
 
+    Parameters
+    ----------
+    filters : optional, Iterable[Filter]
+        Filters the symbols of the snapshot must pass, e.g. [('close', 'between', (5, 20)), ('volume', '>=', 1e6)]
+        or [('symbol', 'in', ['AAPL', 'MSFT'])]. See 'data.snapshot_filters'. Historical snapshots are filtered in
+        the snapshot store, so only the symbols passing the filters are materialized.
+
     Methods
     -------
-    __eq__ : Any
-        Returns 'True' if the object is a MarketSnapshotRequest
-    merge_with : MarketSnapshotRequest
+    __add__ : MarketSnapshotRequest
         Combines two MarketSnapshotRequests.
-        It does this by creating a new MarketSnapshotRequest whose dates encompass the dates of the two original
+        It does this by creating a new MarketSnapshotRequest whose columns encompass the columns of the two original
         MarketSnapShotRequests.
 
+    Attributes
+    ----------
+    data_key : int
+        'day', so the snapshots got at once are keyed by their day.
+
     Notes
     -----
     Even though the class is called 'MarketSnapShotRequest', it actually will request 'grouped_daily_aggs' data from
     Polygon.io.
+    'columns' can be any of 'open', 'high', 'low', 'close', 'volume', 'vwap' and 'trades'. Snapshots downloaded before
+    'vwap' and 'trades' were stored have them as NaN.
 
     """
     def __init__(self, columns: List[str],
                  day: int = 0,
                  shortable: bool = False,
                  min_rel_mkt_cap: Optional[int] = None,
-                 round_to: int = 3):
+                 round_to: int = 3,
+                 filters: Optional[Iterable[Filter]] = None):
         self.day = day
         self.shortable = shortable
         self.min_rel_mkt_cap = min_rel_mkt_cap
+        self.filters = snapshot_filters.normalize(filters)
         super().__init__(columns, round_to)
 
-    def can_merge_with(self, data_request: DataRequest) -> bool:
-        return isinstance(data_request, MarketSnapshotRequest) and self.day == data_request.day and self.shortable == data_request.shortable and self.min_rel_mkt_cap == data_request.min_rel_mkt_cap
+    def get_merge_fields(self) -> Tuple[Any, ...]:
+        return self.day, self.shortable, self.min_rel_mkt_cap, self.filters
 
-    def __add__(self, other):
-        self.columns = list(set(self.columns + other.columns))
-        return self
+    @property
+    def data_key(self) -> int:
+        return self.day
 
-    def __eq__(self, other):
-        return isinstance(other, MarketSnapshotRequest) and self.day == other.day and self.shortable == other.shortable and self.columns == other.columns
-
-    def __hash__(self):
-        return hash(str(self))
+    def __add__(self, other):
+        return MarketSnapshotRequest(list(self.columns + other.columns), self.day, self.shortable, self.min_rel_mkt_cap,
+                                     max(self.round_to, other.round_to), self.filters)
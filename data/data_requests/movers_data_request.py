@@ -0,0 +1,56 @@
+from typing import Any, List, Tuple
+
+from data.data_requests.data_request import DataRequest
+from files.config import Config
+
+
+class MoversRequest(DataRequest):
+    """
+    Requests today's top movers, served from the rankings kept up to date by the live aggregates.
+
+    Parameters
+    ----------
+    columns : List[str]
+        Columns of the live market snapshot to get for the movers.
+    by : str
+        'change' (percent change from the previous close), 'change_from_open' or 'volume'.
+    n : int
+        Number of movers. At most 'live_data.movers'.
+    ascending : bool
+        Whether to get the lowest ranked symbols, e.g. the top losers, instead of the highest.
+
+    Raises
+    ------
+    ValueError
+        If 'n' is more than the 'live_data.movers' movers indexed.
+
+    Methods
+    -------
+    __add__ : MoversRequest
+        Combines two MoversRequests for the same movers into one requesting the columns of both.
+
+    Notes
+    -----
+    The data of the request is a DataFrame indexed by symbol, ordered by rank, with 'columns' and a column named 'by'
+    holding the values ranked on.
+
+    """
+    def __init__(self, columns: List[str],
+                 by: str = 'change',
+                 n: int = 20,
+                 ascending: bool = False,
+                 round_to: int = 3):
+        if n > (max_n := Config.get('live_data.movers', 50)):
+            raise ValueError(f"Only the top {max_n} movers are indexed ('live_data.movers'), {n} were requested")
+
+        self.by = by
+        self.n = n
+        self.ascending = ascending
+        super().__init__(columns, round_to)
+
+    def get_merge_fields(self) -> Tuple[Any, ...]:
+        return self.by, self.n, self.ascending
+
+    def __add__(self, other):
+        return MoversRequest(list(self.columns + other.columns), self.by, self.n, self.ascending,
+                             max(self.round_to, other.round_to))
@@ -0,0 +1,39 @@
+from typing import Any, List, Tuple
+
+from data.data_requests.data_request import DataRequest
+
+
+class PanelRequest(DataRequest):
+    """
+    Requests the market snapshots of the last 'days' market days as one panel aligned on symbols.
+
+    Parameters
+    ----------
+    columns : List[str]
+        Columns of the market snapshots in the panel, its fields.
+    days : int
+        Number of market days before today in the panel.
+
+    Methods
+    -------
+    __add__ : PanelRequest
+        Combines two PanelRequests over the same days into one requesting the columns of both.
+
+    Notes
+    -----
+    The data of the request is a 'Panel', whose values are a days x symbols x fields array, oldest day first, with NaN
+    where a symbol has no snapshot on a day. Every panel loaded on a day shares the same symbols, so the panels of
+    different strategies and requests line up without joins.
+
+    """
+    def __init__(self, columns: List[str],
+                 days: int,
+                 round_to: int = 3):
+        self.days = days
+        super().__init__(columns, round_to)
+
+    def get_merge_fields(self) -> Tuple[Any, ...]:
+        return self.days,
+
+    def __add__(self, other):
+        return PanelRequest(list(self.columns + other.columns), self.days, max(self.round_to, other.round_to))
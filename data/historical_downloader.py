@@ -0,0 +1,343 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date, datetime
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import aiohttp
+import pandas as pd
+
+from data import storage_format
+from files.config import Config
+from logger import log
+
+"""
+Downloads historical data from Polygon.io.
+
+Requests are sent concurrently, bounded by 'polygon_downloads.max_concurrent_requests' and paced by a rate limiter,
+both shared by every download, and retried with exponential backoff. Decoding responses, converting them to DataFrames
+and writing them is done in a pool of worker processes shared by every download, so none of it runs on the event loop.
+"""
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Seconds after which a temporary file left by an interrupted write is removed. Younger ones may still be written to.
+STALE_TMP_AGE = 3600
+
+
+class RateLimiter:
+    """
+    Spaces requests at least '1 / requests_per_second' seconds apart.
+
+    Notes
+    -----
+    Only a threading lock is held, never an asyncio one, so the same limiter can be shared by every event loop
+    and thread that downloads from Polygon.io.
+
+    """
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._next_slot = 0.0
+        self._lock = Lock()
+
+    async def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if (delay := slot - now) > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        """Holds back every request for 'seconds', e.g. after Polygon.io responded with 'Too Many Requests'."""
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+class ConcurrencyLimiter:
+    """
+    Bounds the number of requests in flight to 'max_concurrency', across every event loop and thread.
+
+    Notes
+    -----
+    Like 'RateLimiter', only a threading lock is held, so downloads started from different threads, e.g. the reload,
+    the prefetch and a backfill, share the bound instead of each getting their own.
+
+    """
+    def __init__(self, max_concurrency: int):
+        self._available = max_concurrency
+        self._lock = Lock()
+
+    async def __aenter__(self):
+        while True:
+            with self._lock:
+                if self._available:
+                    self._available -= 1
+                    return
+            await asyncio.sleep(0.01)
+
+    async def __aexit__(self, *_):
+        with self._lock:
+            self._available += 1
+
+
+class DownloadJob:
+    """
+    A file to download from Polygon.io.
+
+    Parameters
+    ----------
+    url : str
+        URL of the data to download.
+    path : str
+        File the data is written to. Jobs writing the same file are processed one at a time.
+    process : Callable
+        Module level function that decodes the response body, converts and writes it. Called in a worker process as
+        'process(body, path, *args)', and returns the number of rows written.
+    *args : Arguments
+        Arguments passed to 'process' after the path.
+
+    """
+    def __init__(self, url: str, path: str, process: Callable[..., int], *args):
+        self.url = url
+        self.path = path
+        self.process = process
+        self.args = args
+
+    def __str__(self):
+        return self.url.split('apiKey=')[0]
+
+
+_rate_limiter: Optional[RateLimiter] = None
+_concurrency_limiter: Optional[ConcurrencyLimiter] = None
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Returns the rate limiter shared by every download from Polygon.io."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(Config.get('polygon_downloads.requests_per_second', 20))
+    return _rate_limiter
+
+
+def get_concurrency_limiter() -> ConcurrencyLimiter:
+    """Returns the limit of requests in flight shared by every download from Polygon.io."""
+    global _concurrency_limiter
+    if _concurrency_limiter is None:
+        _concurrency_limiter = ConcurrencyLimiter(Config.get('polygon_downloads.max_concurrent_requests', 8))
+    return _concurrency_limiter
+
+
+async def download(jobs: List[DownloadJob],
+                   on_done: Optional[Callable[[DownloadJob, int], None]] = None) -> List[int]:
+    """
+    Downloads and processes 'jobs'. Returns the number of rows written by each job.
+
+    Parameters
+    ----------
+    jobs : List[DownloadJob]
+        Files to download.
+    on_done : optional, Callable
+        Called on the event loop with each job and its number of rows as soon as the job is written.
+
+    Raises
+    ------
+    Exception
+        The first error of any job, once every other job has finished.
+
+    """
+    if not jobs:
+        return []
+
+    path_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+    executor = get_executor()
+
+    async def run_job(job: DownloadJob) -> int:
+        body = await fetch(job.url, session)
+        async with path_locks[job.path]:
+            nrows = await asyncio.get_running_loop().run_in_executor(executor, job.process, body, job.path, *job.args)
+        if on_done:
+            on_done(job, nrows)
+        return nrows
+
+    connector = aiohttp.TCPConnector(limit=Config.get('polygon_downloads.max_concurrent_requests', 8), ssl=False)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        results = await asyncio.gather(*[run_job(job) for job in jobs], return_exceptions=True)
+
+    for job, result in zip(jobs, results):
+        if isinstance(result, BaseException):
+            log('market_data/downloader', f'Failed to download {job}: {result!r}')
+            raise result
+
+    return results
+
+
+async def fetch(url: str, session: aiohttp.ClientSession) -> bytes:
+    """
+    Sends a GET request to 'url' and returns the response body, retrying with exponential backoff. A slot of the
+    concurrency limiter is held across the retries and their backoff, so retries never add requests in flight.
+    """
+    rate_limiter = get_rate_limiter()
+    max_retries = Config.get('polygon_downloads.max_retries', 5)
+
+    async with get_concurrency_limiter():
+        attempt = 0
+        while True:
+            await rate_limiter.acquire()
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return await response.read()
+                    if response.status not in RETRY_STATUSES or attempt >= max_retries:
+                        response.raise_for_status()
+                    if response.status == 429:
+                        rate_limiter.pause(float(response.headers.get('Retry-After', 2 ** attempt)))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= max_retries:
+                    raise
+
+            attempt += 1
+            await asyncio.sleep(2 ** attempt * (0.5 + random.random() / 2))
+
+
+def get_executor() -> Executor:
+    """
+    Returns the pool of worker processes shared by every download, started on first use. Its workers are spawned
+    rather than forked, since downloads run while the websocket and reload threads are running.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=Config.get('polygon_downloads.workers', 4),
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def get_snapshot_dates(snapshots_path: str) -> Set[date]:
+    """
+    Returns the dates of every market snapshot stored in 'snapshots_path', and removes the stale temporary files of
+    interrupted writes.
+    """
+    remove_stale_tmp_files(snapshots_path)
+    return {datetime.strptime(file[:-len('.feather')], '%Y-%m-%d').date() for file in os.listdir(snapshots_path)
+            if file.endswith('.feather')}
+
+
+def remove_stale_tmp_files(path: str):
+    """Removes the '.tmp' files in 'path' not written to for 'STALE_TMP_AGE' seconds."""
+    for file in os.listdir(path):
+        if file.endswith('.tmp') and time.time() - os.path.getmtime(tmp_path := os.path.join(path, file)) > \
+                STALE_TMP_AGE:
+            try:
+                os.remove(tmp_path)
+                log('market_data/downloader', f'Removed the stale temporary file {tmp_path!r}')
+            except FileNotFoundError:
+                pass
+
+
+def market_snapshot_job(day: date, snapshots_path: str) -> DownloadJob:
+    url = f'https://api.polygon.io/v2/aggs/grouped/locale/us/market/stocks/{day}?adjusted=false&apiKey={Config.get("polygon_api_key")}'
+    # Compressions are read here since the worker processes do not read the config.
+    return DownloadJob(url, os.path.join(snapshots_path, f'{day}.feather'), process_market_snapshot,
+                       Config.get('storage.snapshot_compression', 'uncompressed'))
+
+
+def stock_data_job(symbol: str, timeframe: str, multiplier: int, from_: date, to: date, stocks_path: str) -> DownloadJob:
+    url = f'https://api.polygon.io/v2/aggs/ticker/{symbol}/range/{multiplier}/{timeframe}/{from_}/{to}?adjusted=false&sort=asc&limit=50000&apiKey={Config.get("polygon_api_key")}'
+    return DownloadJob(url, os.path.join(stocks_path, symbol, f'{timeframe}_{multiplier}.feather'), process_stock_data,
+                       timeframe, Config.get('storage.stock_compression', 'lz4'))
+
+
+def process_market_snapshot(body: bytes, path: str, compression: str) -> int:
+    """Writes a grouped daily aggs response to 'path'. Runs in a worker process."""
+    response = json.loads(body)
+    if not response.get('results'):
+        return 0
+
+    df = market_snapshot_to_dataframe(response)
+    write_market_snapshot(df, path, compression)
+    return len(df)
+
+
+def process_stock_data(body: bytes, path: str, timeframe: str, compression: str) -> int:
+    """Merges a stock aggs response into the stock data at 'path'. Runs in a worker process."""
+    response = json.loads(body)
+    if not response.get('results'):
+        return 0
+
+    df = stock_data_to_dataframe(response, timeframe)
+    if os.path.isfile(path):
+        df = pd.concat([storage_format.read_dataframe(path), df], ignore_index=True)
+        df = df.drop_duplicates(subset='t', keep='first', ignore_index=True)
+        df = df.sort_values(by='t', ignore_index=True)
+    write_stock_data(df, path, compression)
+    return len(df)
+
+
+def market_snapshot_to_dataframe(response: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Converts a response from Polygon.io servers to a DataFrame.
+    Parameters
+    ----------
+    response: Dict[str, Any]
+        Response from Polygon.io servers that will be converted to the returned DataFrame.
+    Notes
+    -----
+    The returned DataFrame contains the columns 'open', 'high', 'low', 'close', 'volume', 'vwap', 'trades'
+    """
+    df = pd.DataFrame(data=response['results'], index=None)
+    df = df.drop(columns=['t'])
+
+    df = df[df['T'].str.isalpha() & df['T'].str.isupper()]
+    df = df.reset_index(drop=True)
+
+    df = df.rename(columns={'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume', 'vw': 'vwap',
+                            'n': 'trades'})
+    df = df.reindex(columns=['T', 'open', 'high', 'low', 'close', 'volume', 'vwap', 'trades'])
+    df = df.astype({'volume': int, 'trades': 'Int64'})
+    return df
+
+
+def stock_data_to_dataframe(response: Dict[str, Any], timeframe: str) -> pd.DataFrame:
+    """
+    Converts a response from Polygon.io servers to a DataFrame.
+    Parameters
+    ----------
+    response: Dict[str, Any]
+        Response from Polygon.io servers that will be converted to the returned DataFrame.
+    Notes
+    -----
+    The returned DataFrame contains the columns 'open', 'high', 'low', 'close', 'volume', 'vwap', 'trades'
+    """
+    df = pd.DataFrame(data=response['results'])
+
+    if timeframe == 'minute' or timeframe == 'hour':
+        df['t'] = pd.to_datetime(df['t'], unit='ms')
+    else:
+        df['t'] = pd.to_datetime(df['t'], unit='ms').dt.date
+
+    df = df.rename(columns={'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume', 'vw': 'vwap',
+                            'n': 'trades'})
+    df = df.reindex(columns=['t', 'open', 'high', 'low', 'close', 'volume', 'vwap', 'trades'])
+    df = df.astype({'volume': int, 'trades': 'Int64'})
+    return df
+
+
+def write_market_snapshot(df: pd.DataFrame, path: str, compression: str = 'uncompressed'):
+    # Written uncompressed by default so the snapshot store can memory-map it without copying.
+    # Written to a temporary file first and moved over 'path', so tables already memory-mapped from it stay valid.
+    storage_format.write(df, f'{path}.tmp', compression)
+    os.replace(f'{path}.tmp', path)
+
+
+def write_stock_data(df: pd.DataFrame, path: str, compression: str = 'lz4'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    storage_format.write(df, path, compression)
@@ -0,0 +1,438 @@
+import time as time_
+from contextlib import contextmanager
+from datetime import datetime, time
+from threading import Condition, Lock
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from data.minute_bars import MinuteBarBuffer
+from data.movers import Movers, MoversIndex
+from utils import t_util
+
+PRICE_FIELDS = ['open', 'high', 'low', 'close']
+
+AGGS_DTYPE = np.dtype([('open', np.float64), ('high', np.float64), ('low', np.float64), ('close', np.float64),
+                       ('volume', np.int64), ('vwap', np.float64), ('trades', np.int64)])
+
+
+class LiveSnapshot:
+    """
+    Immutable snapshot of the live aggregates, published by the websocket thread.
+
+    Attributes
+    ----------
+    seq : int
+        Number of the snapshot. Increases with every publish.
+    published_at : optional, datetime
+        When the snapshot was published.
+    symbols : pd.Index
+        Symbols of the snapshot's rows.
+    aggs : np.ndarray
+        Read-only candles of 'symbols', with prices rounded to 3 decimals.
+    movers : optional, Movers
+        Rankings of the candles, if the live aggregates have a movers index.
+
+    Notes
+    -----
+    'aggs' lives in a buffer the websocket thread reuses once the snapshot is neither published nor pinned.
+    Only use it inside 'LiveAggregates.read_snapshot'.
+
+    """
+    def __init__(self, seq: int, published_at: Optional[datetime], symbols: pd.Index, aggs: np.ndarray,
+                 buffer: np.ndarray, movers: Optional[Movers] = None):
+        self.seq = seq
+        self.published_at = published_at
+        self.symbols = symbols
+        self.aggs = aggs
+        self.movers = movers
+        self._buffer = buffer
+        self._pins = 0
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns the snapshot as a DataFrame whose columns are views of 'aggs'."""
+        return pd.DataFrame({field: self.aggs[field] for field in AGGS_DTYPE.names}, index=self.symbols, copy=False)
+
+    def get_movers(self, by: str, n: int, ascending: bool = False) -> pd.DataFrame:
+        """
+        Returns the candles of the 'n' highest ('n' lowest if 'ascending') symbols by 'by', ordered by it, with a
+        column of their 'by' values if it is not a candle field.
+        """
+        ids, values = self.movers.get(by, n, ascending)
+        movers = pd.DataFrame({field: self.aggs[field][ids] for field in AGGS_DTYPE.names}, index=self.symbols[ids])
+        if by not in movers:
+            movers[by] = values
+        return movers
+
+
+class LiveAggregates:
+    """
+    Today's candle of every symbol, kept in a NumPy structured array indexed by symbol id.
+
+    Parameters
+    ----------
+    capacity : int
+        Number of symbols preallocated for. The table grows when more symbols are seen.
+    minute_bars : optional, MinuteBarBuffer
+        If given, every websocket bar is also appended to it.
+    movers : optional, MoversIndex
+        If given, every published snapshot is ranked by it.
+
+    Methods
+    -------
+    update :
+        Folds a batch of websocket aggregate messages or grouped daily aggs into the candles.
+    set_daily_aggs :
+        Overwrites candles with grouped daily aggs.
+    get_active_symbols : List[str]
+        Returns the symbols that received websocket bars recently, e.g. to fill a gap in the stream.
+    get_minute_bars : pd.DataFrame
+        Returns the last minute bars of symbols from 'minute_bars'.
+    publish :
+        Publishes a snapshot of the candles for other threads to read.
+    read_snapshot : LiveSnapshot
+        Pins and returns the last published snapshot.
+    to_dataframe : pd.DataFrame
+        Returns the candles indexed by symbol.
+
+    Notes
+    -----
+    Prices are stored unrounded and rounded to 3 decimals when read, which gives the same candles as rounding every
+    message since rounding is monotonic.
+    VWAP and the number of trades are cumulative over every websocket bar of the day, in O(1) per bar: each bar adds
+    its VWAP times its volume to the symbol's price volume sum, and its volume over its average trade size to its
+    trades.
+    Only the websocket thread may update the candles. Other threads read published snapshots, which are double
+    buffered: a snapshot is copied into the buffer that is not published and swapped in, so readers never see a
+    batch half applied.
+
+    """
+    def __init__(self, capacity: int = 16384, minute_bars: Optional[MinuteBarBuffer] = None,
+                 movers: Optional[MoversIndex] = None):
+        self.minute_bars = minute_bars
+        self.movers = movers
+        self.symbols: List[str] = []
+        self.size = 0
+        self._symbol_ids: Dict[str, int] = dict()
+        self._valid_symbols: Dict[str, bool] = dict()
+        self.aggs = self._allocate(capacity)
+        # End, in milliseconds, of the last websocket bar of each symbol, and the sum of price times volume of its
+        # bars. Not part of the snapshots.
+        self.bar_ends = np.zeros(capacity, dtype=np.int64)
+        self.price_volumes = np.zeros(capacity, dtype=np.float64)
+
+        self._snapshot: Optional[LiveSnapshot] = None
+        self._free_buffers: List[np.ndarray] = []
+        self._symbols_index = pd.Index([], name='T')
+        self._publish_lock = Lock()
+        self.publish(None)
+
+    @staticmethod
+    def _allocate(capacity: int) -> np.ndarray:
+        aggs = np.zeros(capacity, dtype=AGGS_DTYPE)
+        for field in PRICE_FIELDS + ['vwap']:
+            aggs[field] = np.nan
+        return aggs
+
+    def reset(self):
+        self.symbols = []
+        self.size = 0
+        self._symbol_ids = dict()
+        self.aggs = self._allocate(len(self.aggs))
+        self.bar_ends = np.zeros(len(self.aggs), dtype=np.int64)
+        self.price_volumes = np.zeros(len(self.aggs), dtype=np.float64)
+        if self.minute_bars is not None:
+            self.minute_bars.reset()
+        if self.movers is not None:
+            self.movers.reset()
+        self.publish(None)
+
+    def is_valid_symbol(self, symbol: str) -> bool:
+        valid = self._valid_symbols.get(symbol)
+        if valid is None:
+            valid = symbol.isalpha() and symbol.isupper()
+            self._valid_symbols[symbol] = valid
+        return valid
+
+    def get_ids(self, symbols: List[str]) -> np.ndarray:
+        """Returns the id of each of 'symbols', adding unseen symbols. Invalid symbols get the id -1."""
+        symbol_ids = self._symbol_ids
+        ids = np.empty(len(symbols), dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            symbol_id = symbol_ids.get(symbol)
+            if symbol_id is None:
+                symbol_id = self._add_symbol(symbol) if self.is_valid_symbol(symbol) else -1
+            ids[i] = symbol_id
+        return ids
+
+    def _add_symbol(self, symbol: str) -> int:
+        if self.size == len(self.aggs):
+            aggs = self._allocate(len(self.aggs) * 2)
+            aggs[:self.size] = self.aggs
+            self.aggs = aggs
+            self.bar_ends = np.concatenate([self.bar_ends, np.zeros(len(self.bar_ends), dtype=np.int64)])
+            self.price_volumes = np.concatenate([self.price_volumes, np.zeros(len(self.price_volumes))])
+
+        symbol_id = self.size
+        self._symbol_ids[symbol] = symbol_id
+        self.symbols.append(symbol)
+        self.size += 1
+        return symbol_id
+
+    def update(self, new_aggs_data: List[Dict[str, Any]], daily_aggs: bool, current_time: Optional[time] = None,
+               session_end: Optional[int] = None):
+        """
+        Folds a batch of aggregates into the candles.
+
+        Parameters
+        ----------
+        new_aggs_data : List[Dict[str, Any]]
+            'AM' websocket messages, or grouped daily aggs if 'daily_aggs'.
+        daily_aggs : bool
+            Whether 'new_aggs_data' are grouped daily aggs.
+        current_time : optional, time
+            Time the batch is received at. The clock is read once if not given.
+        session_end : optional, int
+            End of the day's last market minute, in milliseconds. After the close, websocket bars ending at or before
+            it still update prices, since the bars of the last minute are received after the close.
+
+        Notes
+        -----
+        Volume is added for every websocket message. Prices only update the candles during market hours.
+
+        """
+        if not new_aggs_data:
+            return
+
+        if current_time is None:
+            current_time = t_util.get_current_time()
+
+        ids = self.get_ids([symbol_data['sym' if not daily_aggs else 'T'] for symbol_data in new_aggs_data])
+        valid = ids >= 0
+        if not valid.all():
+            new_aggs_data = [symbol_data for symbol_data, valid_ in zip(new_aggs_data, valid) if valid_]
+            ids = ids[valid]
+        if not len(ids):
+            return
+
+        aggs = self.aggs
+        # Websocket bars have an average trade size ('z'), grouped daily aggs a number of trades ('n').
+        values = np.array([(symbol_data['o'], symbol_data['h'], symbol_data['l'], symbol_data['c'], symbol_data['v'],
+                            symbol_data.get('vw', np.nan), symbol_data.get('e', 0),
+                            symbol_data.get('z', 0) if not daily_aggs else symbol_data.get('n', 0))
+                           for symbol_data in new_aggs_data], dtype=np.float64)
+
+        # Bars without a VWAP count at their close.
+        if np.isnan(bar_vwaps := values[:, 5]).any():
+            bar_vwaps = np.where(np.isnan(bar_vwaps), values[:, 3], bar_vwaps)
+
+        if not daily_aggs:
+            bar_ends = values[:, 6].astype(np.int64)
+            np.add.at(aggs['volume'], ids, values[:, 4].astype(np.int64))
+            np.maximum.at(self.bar_ends, ids, bar_ends)
+            if self.minute_bars is not None:
+                self.minute_bars.append(ids, values[:, [0, 1, 2, 3, 4, 5]], bar_ends)
+
+            # Cumulative VWAP and number of trades.
+            np.add.at(self.price_volumes, ids, bar_vwaps * values[:, 4])
+            average_trade_sizes = values[:, 7]
+            trades = np.divide(values[:, 4], average_trade_sizes, out=np.zeros(len(ids)),
+                               where=average_trade_sizes > 0)
+            np.add.at(aggs['trades'], ids, np.rint(trades).astype(np.int64))
+
+            unique_ids = np.unique(ids)
+            volumes = aggs['volume'][unique_ids]
+            aggs['vwap'][unique_ids] = np.divide(self.price_volumes[unique_ids], volumes,
+                                                 out=np.full(len(unique_ids), np.nan), where=volumes > 0)
+
+        if not (t_util.get_market_open_time() <= current_time <= t_util.get_market_close_time()):
+            if daily_aggs or session_end is None or current_time < t_util.get_market_open_time():
+                return
+            if not (in_session := bar_ends <= session_end).any():
+                return
+            ids, values = ids[in_session], values[in_session]
+
+        # Open candles that have not been opened yet with the symbol's first aggregate of the batch.
+        unique_ids, first_idxs = np.unique(ids, return_index=True)
+        unopened = np.isnan(aggs['open'][unique_ids])
+        aggs['open'][unique_ids[unopened]] = values[first_idxs[unopened], 0]
+
+        np.fmax.at(aggs['high'], ids, values[:, 1])
+        np.fmin.at(aggs['low'], ids, values[:, 2])
+
+        # Close is the symbol's last aggregate of the batch.
+        last_idxs = len(ids) - 1 - np.unique(ids[::-1], return_index=True)[1]
+        aggs['close'][unique_ids] = values[last_idxs, 3]
+
+        # Grouped daily aggs already are cumulative.
+        if daily_aggs:
+            aggs['vwap'][unique_ids] = bar_vwaps[last_idxs]
+            aggs['trades'][unique_ids] = values[last_idxs, 7]
+            self.price_volumes[unique_ids] = bar_vwaps[last_idxs] * aggs['volume'][unique_ids]
+
+    def get_last_bar_end(self) -> int:
+        """Returns the end, in milliseconds, of the last websocket bar received, or 0 if none was."""
+        return int(self.bar_ends[:self.size].max()) if self.size else 0
+
+    def get_active_symbols(self, since: int) -> List[str]:
+        """Returns the symbols with a websocket bar ending at or after 'since', in milliseconds."""
+        return [self.symbols[i] for i in np.flatnonzero(self.bar_ends[:self.size] >= since)]
+
+    def get_minute_bars(self, lookback: int, symbols: Optional[List[str]] = None,
+                        columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Returns the last 'lookback' minute bars of 'symbols', or of every symbol, indexed by symbol and bar start."""
+        if self.minute_bars is None:
+            raise ValueError('LiveAggregates has no minute bar buffer')
+
+        if symbols is None:
+            symbols = self.symbols[:self.size]
+            ids = np.arange(len(symbols))
+        else:
+            ids = np.array([self._symbol_ids.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        return self.minute_bars.to_dataframe(symbols, ids, lookback, columns)
+
+    def set_daily_aggs(self, daily_aggs: List[Dict[str, Any]]):
+        """Overwrites the candles of the symbols in 'daily_aggs' with grouped daily aggs."""
+        ids = self.get_ids([symbol_data['T'] for symbol_data in daily_aggs])
+        valid = ids >= 0
+        if not valid.any():
+            return
+
+        values = np.array([(symbol_data['o'], symbol_data['h'], symbol_data['l'], symbol_data['c'], symbol_data['v'],
+                            symbol_data.get('vw', np.nan), symbol_data.get('n', 0))
+                           for symbol_data, valid_ in zip(daily_aggs, valid) if valid_], dtype=np.float64)
+        ids = ids[valid]
+        for i, field in enumerate(AGGS_DTYPE.names):
+            self.aggs[field][ids] = values[:, i]
+        self.price_volumes[ids] = np.nan_to_num(values[:, 5] * values[:, 4])
+
+    def publish(self, published_at: Optional[datetime]):
+        """Copies the candles into a free buffer and swaps it in as the published snapshot."""
+        with self._publish_lock:
+            buffer = self._free_buffers.pop() if self._free_buffers else None
+        if buffer is None or len(buffer) < self.size:
+            buffer = np.empty(len(self.aggs), dtype=AGGS_DTYPE)
+
+        aggs = self.aggs[:self.size]
+        snapshot_aggs = buffer[:self.size]
+        for field in AGGS_DTYPE.names:
+            if field in PRICE_FIELDS:
+                np.round(aggs[field], 3, out=snapshot_aggs[field])
+            else:
+                snapshot_aggs[field] = aggs[field]
+        snapshot_aggs.flags.writeable = False
+
+        if len(self._symbols_index) != self.size:
+            self._symbols_index = pd.Index(self.symbols, name='T')
+
+        movers = self.movers.rank(snapshot_aggs, self.symbols) if self.movers is not None else None
+
+        seq = self._snapshot.seq + 1 if self._snapshot else 0
+        snapshot = LiveSnapshot(seq, published_at, self._symbols_index, snapshot_aggs, buffer, movers)
+
+        with self._publish_lock:
+            previous_snapshot, self._snapshot = self._snapshot, snapshot
+            if previous_snapshot and not previous_snapshot._pins:
+                self._free_buffers.append(previous_snapshot._buffer)
+
+    @contextmanager
+    def read_snapshot(self) -> Iterator[LiveSnapshot]:
+        """
+        Pins the last published snapshot for the duration of the 'with' block, so its buffer is not reused.
+        Copy anything derived from the snapshot that must outlive the block.
+        """
+        with self._publish_lock:
+            snapshot = self._snapshot
+            snapshot._pins += 1
+        try:
+            yield snapshot
+        finally:
+            with self._publish_lock:
+                snapshot._pins -= 1
+                if not snapshot._pins and snapshot is not self._snapshot:
+                    self._free_buffers.append(snapshot._buffer)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        aggs = self.aggs[:self.size]
+        market_snapshot = pd.DataFrame({field: aggs[field] for field in AGGS_DTYPE.names},
+                                       index=pd.Index(self.symbols, name='T'))
+        market_snapshot[PRICE_FIELDS] = market_snapshot[PRICE_FIELDS].round(3)
+        return market_snapshot
+
+
+class MinuteCompletion:
+    """
+    Tracks the minute bars received from the websocket and signals when a minute's bars are all in.
+
+    A minute, identified by the time its bars end at, is considered complete once any of the following is true:
+
+    - A bar of a later minute was received.
+    - At least 'expected_ratio' times the number of bars of the previous minute were received for it.
+    - Bars were received for it, and none for 'quiet_period' seconds since.
+
+    """
+    HISTORY = 5  # Minutes of bar counts kept.
+
+    def __init__(self):
+        self._condition = Condition()
+        self._counts: Dict[int, int] = dict()
+        self._last_received: Dict[int, float] = dict()
+        self._latest_minute = 0
+
+    def record(self, bar_ends: List[int]):
+        """Records the bars of a websocket frame. 'bar_ends' are the bars' end timestamps in milliseconds."""
+        if not bar_ends:
+            return
+
+        received_at = time_.time()
+        minutes, counts = np.unique(np.asarray(bar_ends, dtype=np.int64) // 60000, return_counts=True)
+        with self._condition:
+            for minute, count in zip(minutes.tolist(), counts.tolist()):
+                self._counts[minute] = self._counts.get(minute, 0) + count
+                self._last_received[minute] = received_at
+
+            if (latest_minute := minutes[-1]) > self._latest_minute:
+                self._latest_minute = int(latest_minute)
+                for minute in [minute for minute in self._counts if minute < self._latest_minute - self.HISTORY]:
+                    del self._counts[minute]
+                    del self._last_received[minute]
+
+            self._condition.notify_all()
+
+    def reset(self):
+        with self._condition:
+            self._counts = dict()
+            self._last_received = dict()
+            self._latest_minute = 0
+
+    def is_complete(self, minute_end: datetime, quiet_period: float, expected_ratio: float) -> bool:
+        with self._condition:
+            return self._is_complete(int(minute_end.timestamp()) // 60, quiet_period, expected_ratio)
+
+    def _is_complete(self, minute: int, quiet_period: float, expected_ratio: float) -> bool:
+        if self._latest_minute > minute:
+            return True
+
+        if not (count := self._counts.get(minute)):
+            return False
+
+        if (previous_count := self._counts.get(minute - 1)) and count >= previous_count * expected_ratio:
+            return True
+
+        return time_.time() - self._last_received[minute] >= quiet_period
+
+    def wait(self, minute_end: datetime, deadline: float, quiet_period: float, expected_ratio: float) -> bool:
+        """
+        Blocks until the bars ending at 'minute_end' are complete, or until 'deadline' seconds after 'minute_end'.
+        Returns 'False' if the deadline was reached first.
+        """
+        minute = int(minute_end.timestamp()) // 60
+        deadline_at = minute_end.timestamp() + deadline
+
+        with self._condition:
+            while not self._is_complete(minute, quiet_period, expected_ratio):
+                if (remaining := deadline_at - time_.time()) <= 0:
+                    return False
+                self._condition.wait(min(remaining, quiet_period))
+        return True
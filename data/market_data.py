@@ -1,58 +1,245 @@
 import asyncio
-import copy
 import json
 import os
-import time
-from datetime import datetime
-from threading import Thread
-from typing import List, Dict, Any, Union, Optional
+import re
+import traceback
+from datetime import date, datetime, timedelta
+from threading import Lock, Thread
+from typing import Dict, Hashable, List, Optional, Set, Tuple, Union
 
-import aiohttp
+import numpy as np
 import pandas as pd
 
+import alert
+import main
 import schedule
-from data import daily_aggs_websocket
-from data.data_requests.data_request import DataRequest
+from data import close_of_day, daily_aggs_websocket, historical_downloader, panel, rel_mkt_cap_index, \
+    snapshot_filters, snapshot_recorder, snapshot_view, subscription_manager
+from data.data_requests.data_request import DataRequest, DataRequestKey
+from data.data_requests.intraday_bars_data_request import IntradayBarsRequest
 from data.data_requests.market_snapshot_data_request import MarketSnapshotRequest
+from data.data_requests.movers_data_request import MoversRequest
+from data.data_requests.panel_data_request import PanelRequest
+from data.snapshot_store import SnapshotStore
+from data.panel import Panel
+from data.snapshot_filters import Filter
+from data.snapshot_view import SnapshotView
+from data.split_adjustments import SplitAdjustments
 from files.config import Config
 from files import MIDAS_PATH
 from logger import log, dlog
 from utils import t_util, dreqst_util, r_util
 
-data = dict()
+# Data of each merged data request, by its 'data_key'. Historical market snapshots are held as views of a shared base
+# snapshot per day, materialized by 'get'.
+Data = Dict[DataRequestKey, Dict[Hashable, Union[pd.DataFrame, SnapshotView, Panel]]]
+data: Data = dict()
+# Day 'data' was prepared for. Its relative days, e.g. 'day=-1', point to other dates on any other day.
+data_day: Optional[date] = None
 data_folder = os.path.join(MIDAS_PATH, 'data')
+split_adjustments = SplitAdjustments(os.path.join(data_folder, 'split_factors.feather'))
+snapshot_store = SnapshotStore(os.path.join(data_folder, 'snapshots'), split_adjustments)
 daily_aggs_websocket_thread = None
 
+# Reload prepared in the background before the open.
+reload_lock = Lock()
+reload_thread: Optional[Thread] = None
+prepared_data: Optional[Tuple[Data, date]] = None
+publish_when_prepared = False
+# Set once the reload failed 'market_data.reload_retries' times, so it is no longer waited for while it is retried.
+reload_failing = False
+
 
 def load(data_requests: Optional[List[DataRequest]] = None):
-    # Clear old data.
-    global data
-    data = dict()
+    """
+    Loads the data of 'data_requests', today's data requests if not given, starts the websocket and schedules the
+    reloads. Run at startup, it blocks until the data is loaded.
+    """
+    day = t_util.get_today()
+    publish(prepare(data_requests), day)
+    start_daily_aggs_websocket()
+    add_to_schedule()
+
 
+def prepare(data_requests: Optional[List[DataRequest]] = None) -> Data:
+    """
+    Downloads, indexes and loads the data of 'data_requests', today's data requests if not given, into a new data
+    dict, without touching the published 'data' strategies read from.
+    """
     # Get data requests.
-    if not data_requests:
+    if data_requests is None:
         data_requests = get_today_data_requests()
 
-    if any([data_request.min_rel_mkt_cap for data_request in data_requests]):
-        data_requests = [MarketSnapshotRequest(columns=['close', 'volume'], day=i) for i in range(-1, -11, -1)] + data_requests
+    rel_mkt_cap_requests, movers_requests = get_supporting_data_requests(data_requests)
+
+    # Record splits to adjust historical data for.
+    update_split_adjustments()
 
-    # Split historical data.
-    adjust_historical_data_for_splits()
+    # Reconcile the snapshots written from live aggregates on previous days that were not reconciled yet, before they
+    # are loaded.
+    reconcile_snapshots(before=t_util.get_today(), wait=True)
 
     # Load data.
+    new_data = dict()
     if data_requests:
-        asyncio.run(download_historical_data(data_requests))
-        load_data(data_requests)
+        asyncio.run(download_historical_data(rel_mkt_cap_requests + movers_requests + data_requests))
+        rel_mkt_cap_index.invalidate()
+        if rel_mkt_cap_requests:
+            rel_mkt_cap_index.update(snapshot_store, t_util.add_to_mkt_date(-1))
+        if movers_requests and (previous_day := t_util.add_to_mkt_date(-1)) in snapshot_store:
+            daily_aggs_websocket.live_aggs.movers.set_previous_closes(snapshot_store.get_symbols(previous_day),
+                                                                      snapshot_store.get_column(previous_day, 'close'))
+        new_data = load_data(data_requests)
+
+    # Subscribe the websocket to the symbols the strategies can select today.
+    subscription_manager.update(data_requests, snapshot_store, get_shortable_symbols)
+
+    return new_data
+
+
+def get_supporting_data_requests(data_requests: List[DataRequest]) -> Tuple[List[MarketSnapshotRequest],
+                                                                              List[MarketSnapshotRequest]]:
+    """
+    Returns the market snapshot requests of the days the relative market cap index of 'data_requests' is built from,
+    and of the day the previous closes their movers are ranked by change from are read from.
+    """
+    rel_mkt_cap_requests = []
+    if any([getattr(data_request, 'min_rel_mkt_cap', None) for data_request in data_requests]):
+        rel_mkt_cap_requests = [MarketSnapshotRequest(columns=['close', 'volume'], day=i)
+                                for i in range(-1, -rel_mkt_cap_index.LOOKBACK - 1, -1)]
+
+    movers_requests = []
+    if any([isinstance(data_request, MoversRequest) for data_request in data_requests]):
+        movers_requests = [MarketSnapshotRequest(columns=['close'], day=-1)]
+
+    return rel_mkt_cap_requests, movers_requests
+
+
+def prefetch(day: Optional[date] = None):
+    """
+    Downloads and indexes the historical data needed by the data requests of the strategies scheduled on 'day', the
+    next market day by default, and maps it into the snapshot store in a background thread, so the reload before the
+    open of 'day' finds it on disk and in memory.
+    """
+    if day is None:
+        day = t_util.get_next_market_open_date(t_util.get_tomorrow())
+
+    data_requests = dreqst_util.get_data_requests(schedule.get_strategy_funcs(day))
+    if not data_requests:
+        log('market_data', f'No data requests to prefetch for {day}')
+        return
+    rel_mkt_cap_requests, movers_requests = get_supporting_data_requests(data_requests)
+    data_requests = rel_mkt_cap_requests + movers_requests + data_requests
+
+    def prefetch_():
+        try:
+            asyncio.run(download_historical_data(data_requests, as_of=day))
+            previous_day = t_util.add_to_mkt_date(-1, day)
+            if rel_mkt_cap_requests and previous_day in snapshot_store:
+                rel_mkt_cap_index.update(snapshot_store, previous_day)
+
+            # Map the snapshots the data requests resolve to.
+            days = {day_ for data_request in merge_data_requests(data_requests)
+                    for day_ in get_snapshot_days(data_request, day)}
+            days = sorted(day_ for day_ in days if day_ in snapshot_store)
+            for day_ in days:
+                snapshot_store.get_table(day_)
+            log('market_data', f'Prefetched the snapshots of {[str(day_) for day_ in days]} for {day}')
+        except Exception as e:
+            log('market_data', f'Failed to prefetch the data of {day}: {e!r}')
+
+    Thread(target=prefetch_, name='prefetch', daemon=True).start()
+
+
+def publish(new_data: Data, day: date):
+    """
+    Swaps 'new_data', prepared for 'day', in as the data strategies read from. 'data' is a single assignment, so readers
+    see the old or new dict.
+    """
+    global data, data_day
+    data, data_day = new_data, day
+    log('market_data', f'Published data. Shapes: {get_shapes(data)}')
 
-    # Start websocket to get daily aggs.
+
+def start_daily_aggs_websocket():
+    """Starts the websocket thread to get daily aggs, unless it is already running."""
     global daily_aggs_websocket_thread
-    daily_aggs_websocket_thread = Thread(target=daily_aggs_websocket.load)
-    daily_aggs_websocket_thread.start()
+    if daily_aggs_websocket_thread is None or not daily_aggs_websocket_thread.is_alive():
+        daily_aggs_websocket_thread = Thread(target=daily_aggs_websocket.load)
+        daily_aggs_websocket_thread.start()
 
-    # Schedule reload.
-    add_to_schedule()
 
-    log('market_data', f'Loaded: @0', data)
+def prepare_reload():
+    """
+    Prepares the data of the day's data requests on a background thread ahead of the open, so the midas loop is not
+    blocked by downloads and indexing. The prepared data is swapped in at the open by 'publish_reload'.
+    """
+    global reload_thread, prepared_data, publish_when_prepared, reload_failing
+    with reload_lock:
+        if reload_thread is not None and reload_thread.is_alive():
+            log('market_data', 'A reload is already being prepared')
+            return
+        prepared_data = None
+        publish_when_prepared = False
+        reload_failing = False
+        # Read here, since the midas loop changes the schedule while the reload is prepared.
+        data_requests = get_today_data_requests()
+        reload_thread = Thread(target=run_reload, args=(data_requests, t_util.get_today()), daemon=True)
+        reload_thread.start()
+
+
+def run_reload(data_requests: List[DataRequest], day: date):
+    """
+    Prepares the data of 'data_requests' for 'day', retrying every 'market_data.reload_retry_delay' seconds until it is
+    prepared, 'day' ends or Midas ends. An alert is sent once 'market_data.reload_retries' retries failed. Until the
+    data is prepared, the previous data is not published, and strategies are skipped instead of reading it for the
+    wrong dates.
+    """
+    global prepared_data, publish_when_prepared, reload_failing
+    retries = Config.get('market_data.reload_retries', 2)
+    retry_delay = Config.get('market_data.reload_retry_delay', 60)
+    attempt = 0
+    while True:
+        try:
+            new_data = prepare(data_requests)
+            break
+        except Exception:
+            attempt += 1
+            log('market_data', f'Preparing the reload of {day} failed (attempt {attempt}): {traceback.format_exc()}')
+            if attempt == retries + 1:
+                reload_failing = True
+                alert.alert(f'Preparing the market data of {day} failed {attempt} times. Strategies are skipped until '
+                            f'it is loaded. Retrying every {retry_delay}s')
+            if main.end_midas.wait(retry_delay) or t_util.get_today() != day:
+                log('market_data', f'Stopped preparing the reload of {day}')
+                return
+
+    with reload_lock:
+        reload_failing = False
+        # The open passed while preparing, so the data is published as soon as it is ready.
+        if publish_when_prepared:
+            publish_when_prepared = False
+            publish(new_data, day)
+        else:
+            prepared_data = (new_data, day)
+
+
+def publish_reload():
+    """
+    Swaps the data prepared by 'prepare_reload' in at the open. If it is still being prepared, it is swapped in as soon
+    as it is ready, and 'get' waits for it until then.
+    """
+    global prepared_data, publish_when_prepared
+    with reload_lock:
+        if prepared_data is not None:
+            publish(*prepared_data)
+            prepared_data = None
+        elif reload_thread is not None and reload_thread.is_alive():
+            log('market_data', 'The reload was not prepared by the open. It is published once it is ready')
+            publish_when_prepared = True
+
+    start_daily_aggs_websocket()
+    add_to_schedule()
 
 
 def get_today_data_requests():
@@ -64,25 +251,49 @@ async def load_live_data(data_requests: List[DataRequest]):
     if not data_requests:
         return
 
-    # Wait until 5 second mark for websocket data to come through
-    while t_util.get_current_time().second < 5:
-        time.sleep(1)
-
-    for data_request in merge_data_requests(data_requests):
-        # 'data_request' does not request any live data, so skip it.
-        if data_request.day == 0:
-            # Wait for websocket to receive data for this minute
-            market_snapshot = pd.DataFrame.from_dict(daily_aggs_websocket.daily_aggs_data, orient='index')
-            market_snapshot = format_market_snapshot(market_snapshot, data_request.columns,
-                                                     data_request.shortable, data_request.min_rel_mkt_cap,
-                                                     data_request.round_to)
-            market_snapshot.to_csv('market_snapshot.csv')
-            market_snapshot = {data_request.day: market_snapshot}
-            data_request_market_snapshots = data.get(data_request, dict())
-            data_request_market_snapshots.update(market_snapshot)
-            data[data_request] = data_request_market_snapshots
-            log('market_data', f'Loaded live data. Data: @0', data)
-            return
+    # Wait for the websocket to receive the bars of the minute that just ended.
+    minute_end = t_util.get_current_datetime().replace(second=0, microsecond=0)
+    if not daily_aggs_websocket.minute_completion.wait(minute_end,
+                                                       Config.get('live_data.minute_complete_deadline', 5),
+                                                       Config.get('live_data.minute_quiet_period', 0.5),
+                                                       Config.get('live_data.minute_expected_ratio', 0.95)):
+        log('market_data', f'Bars ending at {minute_end} were not complete by the deadline. Using the bars received')
+
+    with daily_aggs_websocket.live_aggs.read_snapshot() as live_snapshot:
+        for data_request in merge_data_requests(data_requests):
+            # Intraday bars are served from the minute bars kept in memory.
+            if isinstance(data_request, IntradayBarsRequest):
+                bars = daily_aggs_websocket.live_aggs.get_minute_bars(data_request.lookback, data_request.symbols,
+                                                                      list(data_request.columns))
+                data.setdefault(data_request.merge_key, dict())[data_request.data_key] = \
+                    bars.round(data_request.round_to)
+
+            # Movers are served from the rankings of the snapshot.
+            elif isinstance(data_request, MoversRequest):
+                movers = live_snapshot.get_movers(data_request.by, data_request.n, data_request.ascending)
+                movers = movers.drop(columns=set(movers.columns).difference(data_request.columns + (data_request.by,)))
+                data.setdefault(data_request.merge_key, dict())[data_request.data_key] = \
+                    movers.round(data_request.round_to)
+
+            # Only requests for today's data are loaded live.
+            elif data_request.day == 0:
+                market_snapshot = format_market_snapshot(live_snapshot.to_dataframe(), data_request.columns,
+                                                         data_request.shortable, data_request.min_rel_mkt_cap,
+                                                         data_request.round_to, data_request.filters)
+                # Copied since the snapshot's buffer is reused once it is released.
+                market_snapshot = market_snapshot.copy()
+                data.setdefault(data_request.merge_key, dict())[data_request.data_key] = market_snapshot
+
+                if snapshot_recorder.is_enabled():
+                    # Filters are written as their characters that are valid in file names.
+                    label = re.sub(r'[^\w.-]+', '', '_'.join(str(field) for field in data_request.merge_key.fields))
+                    # Copied so strategies modifying their snapshot do not change what is recorded.
+                    snapshot_recorder.record(minute_end, label, market_snapshot.copy())
+
+        published_at = live_snapshot.published_at
+
+    # Only a summary is logged, stringifying the snapshots would hold up the strategies.
+    log('market_data', f'Loaded live data published at {published_at}. Shapes: {get_shapes(data)}')
 
 
 @dlog('market_data', 'Getting: @0')
@@ -92,239 +303,273 @@ def get(data_requests: Union[DataRequest, List[DataRequest], None]):
     if isinstance(data_requests, DataRequest):
         data_requests = [data_requests]
 
+    # Data prepared for another day is never served, its relative days are the wrong dates.
+    if not is_prepared_for_today():
+        log('market_data', f'Not getting the market data prepared for {data_day}, not today')
+        return None
+
+    # Keyed by the data requests' 'data_key', so the data of different kinds of data requests do not overwrite each
+    # other.
     ret = dict()
     for data_request in data_requests:
-        for data_request_, data_ in data.items():
-            if data_request_.can_merge_with(data_request):
-                ret.update(data_)
-                break
+        if (data_ := data.get(data_request.merge_key)) is not None:
+            # Views of historical market snapshots are materialized for the strategy.
+            ret.update({key: data__.to_dataframe() if isinstance(data__, SnapshotView) else data__
+                        for key, data__ in data_.items()})
 
-    ret = (ret if len(ret) > 1 else list(ret.values())[0]) if ret else None
+    # Only a summary is logged, stringifying the data would hold up the strategies.
+    log('market_data', f'Got shapes: {({str(key): data_.shape for key, data_ in ret.items()})}')
 
-    log('market_data', f'Got: {ret}')
+    ret = (ret if len(ret) > 1 else list(ret.values())[0]) if ret else None
 
     return ret
 
 
-def load_data(data_requests: List[DataRequest]):
-    for data_request in data_requests:
-        # Market snapshot request.
-        if (data_request_day := t_util.add_to_mkt_date(data_request.day)) != t_util.get_today():
-            market_snapshot = pd.read_feather(os.path.join(data_folder, 'snapshots', f'{data_request_day}.feather'),
-                                              list(set(data_request.columns + ['T', 'close', 'volume'])))
-            market_snapshot = market_snapshot.set_index('T')
-            market_snapshot = format_market_snapshot(market_snapshot, data_request.columns, data_request.shortable,
-                                                     data_request.min_rel_mkt_cap, data_request.round_to)
-            market_snapshot = {data_request.day: market_snapshot}
-            data_request_market_snapshots = data.get(data_request, dict())
-            data_request_market_snapshots.update(market_snapshot)
-            data[data_request] = data_request_market_snapshots
+def is_prepared_for_today() -> bool:
+    """
+    Returns whether the published data was prepared for today. A reload being prepared is waited for, unless its
+    attempts are failing.
+    """
+    if data_day != t_util.get_today() and reload_thread is not None and reload_thread.is_alive():
+        log('market_data', f'Waiting for the market data of {t_util.get_today()} to be prepared')
+        while data_day != t_util.get_today() and reload_thread.is_alive() and not reload_failing:
+            reload_thread.join(1)
+    return data_day == t_util.get_today()
 
 
-def format_market_snapshot(market_snapshot: pd.DataFrame, columns: List[str], shortable: bool, min_rel_mkt_cap: int,
-                           round_to: int):
-    if min_rel_mkt_cap:
-        past_snapshots = get([MarketSnapshotRequest(columns=['close', 'volume'], day=i) for i in range(-1, -11, -1)])
-        past_rel_mkt_caps: Dict[str, float] = dict()
-        for past_snapshot in list(past_snapshots.values()) + [market_snapshot]:
-            rel_mkt_caps = past_snapshot['close'] * past_snapshot['volume']
-            for symbol, rel_mkt_cap in zip(past_snapshot.index, rel_mkt_caps):
-                past_rel_mkt_caps[symbol] = min(past_rel_mkt_caps.get(symbol, min_rel_mkt_cap), rel_mkt_cap)
-        symbols_with_enough_rel_mkt_cap = [symbol for symbol, rel_mkt_cap in past_rel_mkt_caps.items() if rel_mkt_cap >= min_rel_mkt_cap]
-        market_snapshot = market_snapshot[market_snapshot.index.isin(symbols_with_enough_rel_mkt_cap)]
+def load_data(data_requests: List[DataRequest]) -> Data:
+    """
+    Loads the historical market snapshots of 'data_requests' as views of one base snapshot per day, holding every
+    column requested on the day, and their panels.
+    """
+    today = t_util.get_today()
+    market_snapshot_requests = [(data_request, data_request_day) for data_request in merge_data_requests(data_requests)
+                                if isinstance(data_request, MarketSnapshotRequest) and
+                                (data_request_day := t_util.add_to_mkt_date(data_request.day)) != today]
+
+    # Columns of each day's base snapshot.
+    columns: Dict[date, Set[str]] = dict()
+    for data_request, data_request_day in market_snapshot_requests:
+        columns.setdefault(data_request_day, {'close', 'volume'}).update(data_request.columns)
+    bases = {day: snapshot_store.get_dataframe(day, sorted(columns_)) for day, columns_ in columns.items()}
+
+    # Requests that only differ in columns or rounding share a mask.
+    new_data = dict()
+    masks = dict()
+    for data_request, data_request_day in market_snapshot_requests:
+        base = bases[data_request_day]
+        mask_key = (data_request_day, data_request.shortable, data_request.min_rel_mkt_cap, data_request.filters)
+        if mask_key not in masks:
+            masks[mask_key] = get_market_snapshot_mask(base, data_request.shortable, data_request.min_rel_mkt_cap,
+                                                       data_request.filters, data_request_day)
+        new_data.setdefault(data_request.merge_key, dict())[data_request.data_key] = \
+            SnapshotView(data_request_day, base, data_request.columns, masks[mask_key], data_request.round_to)
+
+    # Panels share one symbol dictionary, so they line up with each other.
+    panel_requests = [data_request for data_request in merge_data_requests(data_requests)
+                      if isinstance(data_request, PanelRequest)]
+    if panel_requests:
+        panel_days = {data_request: get_snapshot_days(data_request) for data_request in panel_requests}
+        symbols = panel.get_symbols(snapshot_store, sorted(set().union(*panel_days.values())))
+        positions = dict()
+        for data_request, days in panel_days.items():
+            new_data.setdefault(data_request.merge_key, dict())[data_request.data_key] = \
+                panel.build(snapshot_store, days, data_request.columns, symbols, data_request.round_to, positions)
+
+    if views := [view for views in new_data.values() for view in views.values() if isinstance(view, SnapshotView)]:
+        log('market_data', f'Memory of the loaded market snapshots:\n{snapshot_view.get_memory_report(views)}')
+    return new_data
+
+
+def get_shapes(data_: Data) -> Dict[str, Dict[str, Tuple[int, ...]]]:
+    return {str(merge_key): {str(key): data__.shape for key, data__ in datas.items()}
+            for merge_key, datas in data_.items()}
 
-    if shortable:
-        shortable_symbols = get_shortable_symbols()
-        market_snapshot = market_snapshot[market_snapshot.index.isin(shortable_symbols)]
+
+def format_market_snapshot(market_snapshot: pd.DataFrame, columns: List[str], shortable: bool, min_rel_mkt_cap: int,
+                           round_to: int, filters: Tuple[Filter, ...] = ()):
+    if (mask := get_market_snapshot_mask(market_snapshot, shortable, min_rel_mkt_cap, filters)) is not None:
+        market_snapshot = market_snapshot[mask]
 
     market_snapshot = market_snapshot.drop(columns=set(market_snapshot.columns).difference(columns))
     market_snapshot = market_snapshot.round(round_to)
     return market_snapshot
 
 
+def get_market_snapshot_mask(market_snapshot: pd.DataFrame, shortable: bool, min_rel_mkt_cap: Optional[int],
+                             filters: Tuple[Filter, ...] = (), day: Optional[date] = None) -> Optional[np.ndarray]:
+    """
+    Returns the mask of the symbols of 'market_snapshot' that pass the filters, or 'None' if there are none.
+    'filters' are evaluated in the snapshot store if 'market_snapshot' is the snapshot of the store's 'day'.
+    """
+    mask = None
+    if min_rel_mkt_cap:
+        mask = rel_mkt_cap_index.get_mask(snapshot_store, market_snapshot, min_rel_mkt_cap)
+
+    if shortable:
+        shortable_mask = market_snapshot.index.isin(get_shortable_symbols())
+        mask = shortable_mask if mask is None else mask & shortable_mask
+
+    if filters:
+        filters_mask = snapshot_store.query(day, filters) if day is not None else \
+            snapshot_filters.get_mask(market_snapshot, filters)
+        mask = filters_mask if mask is None else mask & filters_mask
+    return mask
+
+
 def get_shortable_symbols() -> List[str]:
     with open(os.path.join(data_folder, 'shortable_symbols.json'), 'r') as file:
         return [symbol for symbol, shortable in json.load(file).items() if shortable]
 
 
-def adjust_historical_data_for_splits():
-    # Get the days we need to create_child data for.
+def update_split_adjustments():
+    """Records the splits executed since the last update. Historical data is adjusted for them when it is read."""
     with open(os.path.join(MIDAS_PATH, 'data', 'splits.json'), 'r') as file:
         last_split_date = datetime.strptime(json.load(file)['last_split_date'], '%Y-%m-%d').date()
 
-    dates_to_split_for = t_util.get_market_dates(last_split_date, t_util.get_today())
-
-    for split_date in dates_to_split_for:
-
+    for split_date in t_util.get_market_dates(last_split_date, t_util.get_today()):
         splits = r_util.send_request(
             method='GET',
             url=f'https://api.polygon.io/v3/reference/splits?execution_date={split_date}&limit=1000&apiKey={Config.get("polygon_api_key")}',
             accept_bad_response=False).json()['results']
+        split_adjustments.add(splits)
 
-        # Adjust market snapshots.
-        dates_before_splits = [day for file in os.listdir(os.path.join(data_folder, 'snapshots')) if
-                               (day := datetime.strptime(file.split('.')[0], '%Y-%m-%d').date()) < split_date]
-
-        market_snapshots_to_adjust = {day: pd.read_feather(os.path.join(data_folder, 'snapshots', f'{day}.feather')) for day in dates_before_splits}
-
-        for day, df in market_snapshots_to_adjust.items():
-            for split in splits:
-                symbol = split['ticker']
-                try:
-                    symbol_idx = list(df['T']).index(symbol)
-                except ValueError:
-                    continue  # No data for this stock.
-
-                split_by = split['split_from'] / split['split_to']
-
-                stock_data = df.iloc[symbol_idx]
-                df.iloc[symbol_idx] = [symbol,
-                                       round(stock_data['open'] * split_by, 4),
-                                       round(stock_data['high'] * split_by, 4),
-                                       round(stock_data['low'] * split_by, 4),
-                                       round(stock_data['close'] * split_by, 4),
-                                       stock_data['volume']]
-            df.to_feather(os.path.join(data_folder, 'snapshots', f'{day}.feather'))
-
-        # Adjust stocks data.
-        for split in splits:
-            symbol = split['ticker']
-            split_by = split['split_from'] / split['split_to']
-            if os.path.isdir(symbol_data_path := os.path.join(data_folder, 'stocks', symbol)):
-                for file in os.listdir(symbol_data_path):
-                    df = pd.read_feather(os.path.join(symbol_data_path, file))
-                    pre_df = df.loc[df['t'] < split_date].copy()
-                    pre_df['open'] = round(pre_df['open'] * split_by, 4)
-                    pre_df['high'] = round(pre_df['high'] * split_by, 4)
-                    pre_df['low'] = round(pre_df['low'] * split_by, 4)
-                    pre_df['close'] = round(pre_df['close'] * split_by, 4)
-
-                    post_df = df.loc[df['t'] >= split_date]
-                    df = pd.concat([pre_df, post_df])
-                    df.to_feather(os.path.join(symbol_data_path, file))
-
-    # Set new last create_child date
+    # Set new last split date
     with open(os.path.join(MIDAS_PATH, 'data', 'splits.json'), 'w') as file:
         file.write(json.dumps({'last_split_date': t_util.get_today().strftime('%Y-%m-%d')}))
 
 
-async def download_historical_data(data_requests: List[DataRequest]):
-    urls_to_download = []
+def materialize_split_adjusted_data(dest_path: str) -> int:
+    """Writes a split adjusted copy of all historical data to 'dest_path'. Returns the number of files written."""
+    return split_adjustments.materialize(os.path.join(data_folder, 'snapshots'), os.path.join(data_folder, 'stocks'),
+                                         dest_path)
 
-    # Get URLs to download from Polygon.io
-    for data_request in merge_data_requests(data_requests):
-        # Market snapshots
-        existing_data_dates = [datetime.strptime(file.split('.')[0], '%Y-%m-%d').date() for file in
-                               os.listdir(os.path.join(data_folder, 'snapshots'))]
-        data_request_day = t_util.add_to_mkt_date(data_request.day)
-        if data_request_day != t_util.get_today() and data_request_day not in existing_data_dates:
-            url = f'https://api.polygon.io/v2/aggs/grouped/locale/us/market/stocks/{data_request_day}?adjusted=false&apiKey={Config.get("polygon_api_key")}'
-            urls_to_download.append(url)
 
-    # Download data from Polygon.io
-    async with aiohttp.ClientSession() as session:
-        responses = await asyncio.gather(*[fetch(url, session) for url in urls_to_download])
-
-        for url, response in zip(urls_to_download, responses):
-            response = await response.json()
-            split_url = url.split('/')
-
-            # Response was a market snapshot
-            if 'aggs/grouped' in url:
-                df = market_snapshot_to_dataframe(response)
-                date_ = split_url[10].split('?')[0]
-                write_market_snapshot(df, date_)
-            # Response was a stock's data
-            else:
-                symbol, timeframe, multiplier = split_url[6], split_url[9], int(split_url[8])
-                df = stock_data_to_dataframe(response, timeframe)
-                if os.path.isfile(existing_data_path := os.path.join(data_folder, 'stocks', symbol,
-                                                                     f'{timeframe}_{multiplier}.feather')):
-                    df = pd.concat([pd.read_feather(existing_data_path), df], ignore_index=True)
-                    df = df.drop_duplicates(subset='t', keep='first', ignore_index=True)
-                    df = df.sort_values(by='t', ignore_index=True)
-                write_stock_data(df, symbol, timeframe, multiplier)
-
-
-def market_snapshot_to_dataframe(response: Dict[str, Any]) -> pd.DataFrame:
+async def download_historical_data(data_requests: List[DataRequest], as_of: Optional[date] = None):
     """
-    Converts a response from Polygon.io servers to a DataFrame.
-    Parameters
-    ----------
-    response: Dict[str, Any]
-        Response from Polygon.io servers that will be converted to the returned DataFrame.
-    Notes
-    -----
-    The returned DataFrame contains the columns 'open', 'high', 'low', 'close', 'volume'
+    Downloads the market snapshots of 'data_requests' that are not on disk, resolving their days relative to 'as_of',
+    today by default.
     """
-    df = pd.DataFrame(data=response['results'], index=None)
-    df = df.drop(columns=['vw', 't', 'n'])
+    if as_of is None:
+        as_of = t_util.get_today()
 
-    df = df[df['T'].str.isalpha() & df['T'].str.isupper()]
-    df = df.reset_index(drop=True)
+    snapshots_path = os.path.join(data_folder, 'snapshots')
+    existing_data_dates = historical_downloader.get_snapshot_dates(snapshots_path)
 
-    df = df.rename(columns={'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume'})
-    df = df.reindex(columns=['T', 'open', 'high', 'low', 'close', 'volume'])
-    df = df.astype({'volume': int})
-    return df
+    # Get market snapshots to download from Polygon.io
+    days_to_download = set()
+    for data_request in merge_data_requests(data_requests):
+        days_to_download.update(day for day in get_snapshot_days(data_request, as_of) if day not in existing_data_dates)
 
+    # Download data from Polygon.io
+    jobs = [historical_downloader.market_snapshot_job(day, snapshots_path) for day in sorted(days_to_download)]
+    await historical_downloader.download(jobs)
+    for day in days_to_download:
+        snapshot_store.evict(day)
 
-def stock_data_to_dataframe(response: Dict[str, Any], timeframe: str) -> pd.DataFrame:
-    """
-    Converts a response from Polygon.io servers to a DataFrame.
-    Parameters
-    ----------
-    response: Dict[str, Any]
-        Response from Polygon.io servers that will be converted to the returned DataFrame.
-    Notes
-    -----
-    The returned DataFrame contains the columns 'open', 'high', 'low', 'close', 'volume'
-    """
-    df = pd.DataFrame(data=response['results'])
 
-    if timeframe == 'minute' or timeframe == 'hour':
-        df['t'] = pd.to_datetime(df['t'], unit='ms')
-    else:
-        df['t'] = pd.to_datetime(df['t'], unit='ms').dt.date
+def get_snapshot_days(data_request: DataRequest, as_of: Optional[date] = None) -> List[date]:
+    """Returns the days of the historical market snapshots 'data_request' reads, relative to 'as_of', or today."""
+    if as_of is None:
+        as_of = t_util.get_today()
 
-    df = df.drop(columns=['vw', 'n'])
+    if isinstance(data_request, MarketSnapshotRequest):
+        day = t_util.add_to_mkt_date(data_request.day, as_of)
+        return [day] if day != as_of else []
+    if isinstance(data_request, PanelRequest):
+        return t_util.get_market_dates(t_util.add_to_mkt_date(-data_request.days, as_of),
+                                       t_util.add_to_mkt_date(-1, as_of))
+    return []
 
-    df = df.rename(columns={'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume'})
-    df = df.reindex(columns=['t', 'open', 'high', 'low', 'close', 'volume'])
-    df = df.astype({'volume': int})
-    return df
 
+def merge_data_requests(data_requests: List[DataRequest]) -> List[DataRequest]:
+    """Merges 'data_requests' to send the minimum number of requests to Polygon.io servers."""
+    merged_data_requests: Dict[DataRequestKey, DataRequest] = dict()
+    for data_request in data_requests:
+        if (merged_data_request := merged_data_requests.get(data_request.merge_key)) is not None:
+            data_request = merged_data_request + data_request
+        merged_data_requests[data_request.merge_key] = data_request
+    return list(merged_data_requests.values())
 
-def write_market_snapshot(df: pd.DataFrame, date_: str):
-    df.to_feather(os.path.join(data_folder, 'snapshots', f'{date_}.feather'))
 
+def write_close_of_day_snapshot():
+    """
+    Writes today's live aggregates to today's snapshot, so it is not downloaded tomorrow, and schedules its
+    reconciliation with Polygon.io's grouped daily aggs after 'snapshots.reconcile_delay' minutes. Waits for the
+    websocket to receive the bars of the last minute first, at most 'polygon_websocket.close_grace' seconds.
 
-def write_stock_data(df: pd.DataFrame, symbol: str, timeframe: str, multiplier: int):
-    symbol_data_path = os.path.join(data_folder, 'stocks', symbol)
-    if not os.path.isdir(symbol_data_path):
-        os.mkdir(symbol_data_path)
-    df.to_feather(os.path.join(symbol_data_path, f'{timeframe}_{multiplier}.feather'))
+    Nothing is written unless the websocket covered the whole session, e.g. if it started after the open, so the
+    snapshot is downloaded instead of saving a partial day.
+    """
+    # Only a websocket subscribed to every symbol has the whole market.
+    if not subscription_manager.is_wildcard():
+        log('market_data', 'Not writing the live aggregates to a snapshot, the websocket is not subscribed to every '
+                           'symbol')
+        return
 
+    # The bars of the last minute are received after the close.
+    if not daily_aggs_websocket.session_closed.wait(Config.get('polygon_websocket.close_grace', 60)):
+        log('market_data', 'The bars of the last minute were not received. Writing the live aggregates received')
 
-def merge_data_requests(data_requests: List[DataRequest]) -> List[DataRequest]:
-    """Merges 'data_requests' to send the minimum number of requests to Polygon.io servers."""
-    data_requests = copy.copy(data_requests)
-    merged_data_requests = [data_requests[0]]
-    data_requests.remove(data_requests[0])
-    for data_request in data_requests:
-        for i, merged_data_request in enumerate(merged_data_requests):
-            if data_request.can_merge_with(merged_data_request):
-                merged_data_requests[i] += data_request
-                break
-        else:
-            merged_data_requests.append(data_request)
-    return merged_data_requests
+    if not daily_aggs_websocket.is_session_covered():
+        log('market_data', 'Not writing the live aggregates to a snapshot, the websocket did not receive the whole '
+                           'session. It is downloaded instead')
+        return
 
+    with daily_aggs_websocket.live_aggs.read_snapshot() as live_snapshot:
+        nsymbols = close_of_day.write_live_snapshot(snapshot_store, live_snapshot, t_util.get_today())
+    log('market_data', f'Wrote the live aggregates of {nsymbols} symbols to the snapshot of {t_util.get_today()}')
 
-def fetch(url, session) -> Dict[str, Any]:
-    """Sends HTML request to the given 'url'"""
-    return session.get(url, ssl=False)
+    schedule.add(t_util.get_current_datetime() + timedelta(minutes=Config.get('snapshots.reconcile_delay', 120)),
+                 reconcile_snapshots)
+
+
+def reconcile_snapshots(before: Optional[date] = None, wait: bool = False):
+    """
+    Reconciles the provisional snapshots, of days before 'before' if given, with Polygon.io's grouped daily aggs in a
+    background thread, or in this one if 'wait'.
+    """
+    days = [day for day in close_of_day.get_provisional_days(snapshot_store) if before is None or day < before]
+
+    def reconcile():
+        for day in days:
+            try:
+                stats = asyncio.run(close_of_day.reconcile(snapshot_store, day))
+                log('market_data', f'Reconciled the snapshot of {day}: {stats}' if stats is not None else
+                                   f'Polygon.io has no grouped daily aggs of {day} yet. Its snapshot stays provisional')
+            except Exception as e:
+                log('market_data', f'Failed to reconcile the snapshot of {day}: {e!r}')
+
+    if wait:
+        reconcile()
+    else:
+        Thread(target=reconcile, name='reconcile_snapshots', daemon=True).start()
 
 
 def add_to_schedule():
-    schedule.add(t_util.get_market_open_time(), load)
+    # Prepare the reload in the background ahead of the open, and swap it in at the open.
+    open_time = t_util.get_market_open_time()
+    prepare_time = (datetime.combine(t_util.get_today(), open_time) -
+                    timedelta(minutes=Config.get('market_data.reload_lead', 15))).time()
+    if not is_scheduled(prepare_reload):
+        schedule.add(prepare_time, prepare_reload)
+    if not is_scheduled(publish_reload):
+        schedule.add(open_time, publish_reload)
+
+    # Prefetch the next market day's data after today's snapshot is reconciled, once.
+    prefetch_time = (datetime.combine(t_util.get_today(), t_util.get_market_close_time()) +
+                     timedelta(minutes=Config.get('market_data.prefetch_delay', 150))).time()
+    if not is_scheduled(prefetch):
+        schedule.add(prefetch_time, prefetch)
+
+    # Write the live aggregates to today's snapshot at the close, once.
+    close_time = (datetime.combine(t_util.get_today(), t_util.get_market_close_time()) +
+                  timedelta(minutes=Config.get('snapshots.close_delay', 1))).time()
+    if not is_scheduled(write_close_of_day_snapshot):
+        schedule.add(close_time, write_close_of_day_snapshot)
+
+
+def is_scheduled(func) -> bool:
+    """Whether 'func' is scheduled to run later, ignoring the entry of the minute being run."""
+    current_datetime = t_util.get_current_datetime()
+    return any(func in funcs for run_time, funcs in schedule.schedule.items() if run_time > current_datetime)
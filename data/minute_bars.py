@@ -0,0 +1,145 @@
+from threading import Lock
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from files.config import Config
+
+BAR_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'vwap']
+
+
+class MinuteBarBuffer:
+    """
+    The last 'length' minute bars of every symbol, kept in preallocated ring buffers indexed by symbol id.
+
+    Parameters
+    ----------
+    length : optional, int
+        Number of bars kept per symbol. Read from 'live_data.minute_bars' when the buffers are first allocated if not
+        given.
+
+    Methods
+    -------
+    append :
+        Appends a batch of websocket bars.
+    to_dataframe : pd.DataFrame
+        Returns the last bars of symbols, indexed by symbol and bar start.
+
+    Notes
+    -----
+    Symbol ids are the ids of the 'LiveAggregates' the buffer is attached to, which appends every websocket bar it
+    receives. The buffers grow with the number of symbols, by doubling.
+    A bar that does not end after the last bar of its symbol is dropped, so bars received twice are only kept once.
+
+    """
+    def __init__(self, length: Optional[int] = None):
+        self.length = length
+        self.values: Optional[np.ndarray] = None  # (symbol, bar, field) with fields 'BAR_FIELDS'.
+        self.ends: Optional[np.ndarray] = None  # (symbol, bar) end of the bars in milliseconds.
+        self.heads: Optional[np.ndarray] = None  # Position the next bar of each symbol is written at.
+        self.counts: Optional[np.ndarray] = None  # Number of bars of each symbol, at most 'length'.
+        self._lock = Lock()
+
+    def _ensure_capacity(self, nsymbols: int):
+        if self.length is None:
+            self.length = Config.get('live_data.minute_bars', 60)
+
+        capacity = 0 if self.values is None else len(self.values)
+        if nsymbols <= capacity:
+            return
+
+        new_capacity = max(capacity, 1024)
+        while new_capacity < nsymbols:
+            new_capacity *= 2
+
+        values = np.full((new_capacity, self.length, len(BAR_FIELDS)), np.nan)
+        ends = np.zeros((new_capacity, self.length), dtype=np.int64)
+        heads = np.zeros(new_capacity, dtype=np.int64)
+        counts = np.zeros(new_capacity, dtype=np.int64)
+        if capacity:
+            values[:capacity] = self.values
+            ends[:capacity] = self.ends
+            heads[:capacity] = self.heads
+            counts[:capacity] = self.counts
+        self.values, self.ends, self.heads, self.counts = values, ends, heads, counts
+
+    def reset(self):
+        with self._lock:
+            self.values = self.ends = self.heads = self.counts = None
+
+    def append(self, ids: np.ndarray, values: np.ndarray, ends: np.ndarray):
+        """
+        Appends bars to the buffers of their symbols.
+
+        Parameters
+        ----------
+        ids : np.ndarray
+            Symbol id of each bar.
+        values : np.ndarray
+            (bar, field) values of the bars, with fields 'BAR_FIELDS'.
+        ends : np.ndarray
+            End of each bar in milliseconds. A symbol's bars must be in chronological order.
+
+        """
+        if not len(ids):
+            return
+
+        with self._lock:
+            self._ensure_capacity(int(ids.max()) + 1)
+
+            # A batch usually holds one bar per symbol. Otherwise, append the symbols' first bars, then their second
+            # bars and so on, so no ring buffer position is written twice at once.
+            order = np.argsort(ids, kind='stable')
+            group_starts = np.flatnonzero(np.r_[True, np.diff(ids[order]) != 0])
+            ranks = np.arange(len(ids)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(ids)]))
+            if not ranks.any():
+                self._append_unique(ids, values, ends)
+                return
+
+            for rank in range(int(ranks.max()) + 1):
+                idxs = order[ranks == rank]
+                self._append_unique(ids[idxs], values[idxs], ends[idxs])
+
+    def _append_unique(self, ids: np.ndarray, values: np.ndarray, ends: np.ndarray):
+        heads = self.heads[ids]
+        last_ends = self.ends[ids, (heads - 1) % self.length]
+        new = ends > last_ends
+        if not new.all():
+            ids, values, ends, heads = ids[new], values[new], ends[new], heads[new]
+
+        self.values[ids, heads] = values
+        self.ends[ids, heads] = ends
+        self.heads[ids] = (heads + 1) % self.length
+        self.counts[ids] = np.minimum(self.counts[ids] + 1, self.length)
+
+    def to_dataframe(self, symbols: List[str], ids: np.ndarray, lookback: int,
+                     columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the last 'lookback' bars of 'symbols', whose symbol ids are 'ids', as a DataFrame indexed by symbol
+        ('T') and bar start ('t'). Symbols with an id of -1 have no bars.
+        """
+        columns = [column for column in BAR_FIELDS if column in (columns or BAR_FIELDS)]
+        field_idxs = [BAR_FIELDS.index(column) for column in columns]
+
+        with self._lock:
+            if self.values is None:
+                return pd.DataFrame(columns=columns, index=pd.MultiIndex.from_arrays([[], []], names=['T', 't']))
+
+            known = (ids >= 0) & (ids < len(self.values))
+            symbols = np.asarray(symbols, dtype=object)[known]
+            ids = ids[known]
+            lookback = min(lookback, self.length)
+
+            # Positions of each symbol's last 'lookback' bars, oldest first, and which of them hold bars.
+            positions = (self.heads[ids, None] - lookback + np.arange(lookback)) % self.length
+            valid = np.arange(lookback) >= lookback - np.minimum(self.counts[ids], lookback)[:, None]
+            values = self.values[ids[:, None], positions][valid][:, field_idxs]
+            ends = self.ends[ids[:, None], positions][valid]
+
+        index = pd.MultiIndex.from_arrays([np.repeat(symbols, valid.sum(axis=1)),
+                                           pd.to_datetime(ends - 60000, unit='ms')], names=['T', 't'])
+        bars = pd.DataFrame(values, index=index, columns=columns)
+        if 'volume' in bars.columns:
+            bars['volume'] = bars['volume'].astype(np.int64)
+        return bars
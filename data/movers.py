@@ -0,0 +1,117 @@
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from files.config import Config
+
+RANKINGS = ['change', 'change_from_open', 'volume']
+
+
+class Movers:
+    """
+    The top and bottom 'k' symbol ids of a snapshot for each ranking, ordered best first.
+
+    Attributes
+    ----------
+    k : int
+        Number of symbol ids kept at each end of each ranking.
+    top : Dict[str, Tuple[np.ndarray, np.ndarray]]
+        Ids and values of the highest ranked symbols of each ranking.
+    bottom : Dict[str, Tuple[np.ndarray, np.ndarray]]
+        Ids and values of the lowest ranked symbols of each ranking.
+
+    """
+    def __init__(self, k: int, top: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                 bottom: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.k = k
+        self.top = top
+        self.bottom = bottom
+
+    def get(self, by: str, n: int, ascending: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the ids and values of the 'n' highest ('n' lowest if 'ascending') symbols by 'by', in O(n)."""
+        if n > self.k:
+            raise ValueError(f'Only the top {self.k} movers are indexed, {n} were requested')
+        ids, values = (self.bottom if ascending else self.top)[by]
+        return ids[:n], values[:n]
+
+
+class MoversIndex:
+    """
+    Ranks the symbols of every published live snapshot by percent change from the previous close ('change'), percent
+    change from the open ('change_from_open') and volume ('volume').
+
+    Parameters
+    ----------
+    k : optional, int
+        Number of symbols kept at each end of each ranking. Read from 'live_data.movers' when first ranking if not
+        given.
+
+    Notes
+    -----
+    Each ranking is an 'np.argpartition' of the snapshot, O(symbols) per published batch, so getting the top movers
+    when a strategy runs is O(k) instead of a sort of the whole market.
+    Symbols without a previous close, or with prices that are NaN, are not ranked by change.
+    Previous closes are set by the thread preparing the reload while the websocket thread ranks, so they and their
+    alignment with symbol ids are only ever replaced whole, under a lock, never changed in place.
+
+    """
+    def __init__(self, k: Optional[int] = None):
+        self.k = k
+        self._previous_closes: Dict[str, float] = dict()
+        # Previous closes aligned with the symbol ids of the live aggregates.
+        self._aligned_previous_closes = np.empty(0)
+        self._lock = Lock()
+
+    def set_previous_closes(self, symbols: pd.Index, closes: np.ndarray):
+        previous_closes = dict(zip(symbols, closes.tolist()))
+        with self._lock:
+            self._previous_closes = previous_closes
+            self._aligned_previous_closes = np.empty(0)
+
+    def reset(self):
+        """Forgets the alignment of previous closes with symbol ids, e.g. when the live aggregates are reset."""
+        with self._lock:
+            self._aligned_previous_closes = np.empty(0)
+
+    def _get_previous_closes(self, symbols: List[str]) -> np.ndarray:
+        with self._lock:
+            previous_closes, aligned = self._previous_closes, self._aligned_previous_closes
+        if len(aligned) < len(symbols):
+            new_closes = [previous_closes.get(symbol, np.nan) for symbol in symbols[len(aligned):]]
+            new_aligned = np.concatenate([aligned, np.array(new_closes, dtype=np.float64)])
+            with self._lock:
+                # Only kept if the previous closes were not replaced, or their alignment reset, in the meantime.
+                if self._aligned_previous_closes is aligned:
+                    self._aligned_previous_closes = new_aligned
+            aligned = new_aligned
+        return aligned[:len(symbols)]
+
+    def rank(self, aggs: np.ndarray, symbols: List[str]) -> Movers:
+        """Ranks the candles 'aggs' of 'symbols', whose ids are their positions."""
+        if self.k is None:
+            self.k = Config.get('live_data.movers', 50)
+
+        closes = aggs['close']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rankings = {'change': closes / self._get_previous_closes(symbols) - 1,
+                        'change_from_open': closes / aggs['open'] - 1,
+                        'volume': aggs['volume'].astype(np.float64)}
+
+        top, bottom = dict(), dict()
+        for by, values in rankings.items():
+            values = np.where(np.isfinite(values), values, np.nan)
+            top[by] = get_top_k(values, self.k)
+            bottom[by] = get_top_k(-values, self.k)
+            bottom[by] = (bottom[by][0], -bottom[by][1])
+        return Movers(self.k, top, bottom)
+
+
+def get_top_k(values: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the positions and values of the 'k' largest of 'values', largest first, ignoring NaNs."""
+    ids = np.flatnonzero(~np.isnan(values))
+    if len(ids) > k:
+        ids = ids[np.argpartition(-values[ids], k - 1)[:k]]
+    ids = ids[np.argsort(-values[ids], kind='stable')]
+    return ids, values[ids]
@@ -0,0 +1,84 @@
+from datetime import date
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data.snapshot_store import SnapshotStore
+
+
+class Panel:
+    """
+    Market snapshots of consecutive market days aligned on symbols.
+
+    Attributes
+    ----------
+    days : List[date]
+        Days of the panel, oldest first.
+    symbols : pd.Index
+        Symbols of the panel. A symbol's position is its id, shared by every panel built on the same symbols.
+    fields : Tuple[str, ...]
+        Columns of the market snapshots in the panel.
+    values : np.ndarray
+        days x symbols x fields array, NaN where a symbol has no snapshot on a day.
+
+    Methods
+    -------
+    get : np.ndarray
+        Returns the days x symbols values of a field.
+    get_ids : np.ndarray
+        Returns the ids of symbols, -1 for symbols not in the panel.
+
+    """
+    def __init__(self, days: List[date], symbols: pd.Index, fields: Tuple[str, ...], values: np.ndarray):
+        self.days = days
+        self.symbols = symbols
+        self.fields = fields
+        self.values = values
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.values.shape
+
+    def get(self, field: str) -> np.ndarray:
+        return self.values[:, :, self.fields.index(field)]
+
+    def get_ids(self, symbols: List[str]) -> np.ndarray:
+        return self.symbols.get_indexer(symbols)
+
+    def __str__(self):
+        return f'Panel({self.days[0] if self.days else None} to {self.days[-1] if self.days else None}, ' \
+               f'{len(self.symbols)} symbols, fields {self.fields})'
+
+
+def get_symbols(snapshot_store: SnapshotStore, days: List[date]) -> pd.Index:
+    """Returns the sorted union of the symbols of the snapshots of 'days', the symbol ids of the panels built on it."""
+    symbols = [snapshot_store.get_symbols(day).to_numpy() for day in days if day in snapshot_store]
+    return pd.Index(np.unique(np.concatenate(symbols)) if symbols else [], dtype=object, name='T')
+
+
+def build(snapshot_store: SnapshotStore, days: List[date], fields: Tuple[str, ...], symbols: pd.Index, round_to: int,
+          positions: Dict[date, np.ndarray]) -> Panel:
+    """
+    Builds the panel of 'fields' over 'days' on 'symbols'.
+
+    Parameters
+    ----------
+    positions : Dict[date, np.ndarray]
+        Positions in 'symbols' of the symbols of each day's snapshot. Filled in for the days missing from it, so panels
+        built on the same symbols align each day once.
+
+    """
+    values = np.full((len(days), len(symbols), len(fields)), np.nan)
+    for i, day in enumerate(days):
+        if day not in snapshot_store:
+            continue
+        if (day_positions := positions.get(day)) is None:
+            day_positions = positions[day] = symbols.get_indexer(snapshot_store.get_symbols(day))
+
+        column_names = snapshot_store.get_table(day).column_names
+        for j, field in enumerate(fields):
+            if field in column_names:
+                values[i, day_positions, j] = snapshot_store.get_column(day, field)
+
+    return Panel(days, symbols, fields, np.round(values, round_to, out=values))
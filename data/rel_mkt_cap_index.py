@@ -0,0 +1,131 @@
+import json
+import os
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from data import storage_format
+from data.snapshot_store import SnapshotStore
+from utils import t_util
+
+"""
+Index of each symbol's minimum relative market cap (close * volume) over the last 'LOOKBACK' market days.
+
+One index file is kept per market day in 'data/rel_mkt_caps', next to the snapshots it is built from. The index for a
+day covers that day and the 'LOOKBACK' - 1 market days before it.
+"""
+
+LOOKBACK = 10
+
+_indexes: Dict[date, pd.Series] = dict()
+
+
+def get_index_path(snapshot_store: SnapshotStore, day: date) -> str:
+    return os.path.join(os.path.dirname(snapshot_store.snapshots_path), 'rel_mkt_caps', f'{day}.feather')
+
+
+def get_window(day: date) -> List[date]:
+    """Returns the market days covered by the index of 'day'."""
+    return t_util.get_market_dates(day - timedelta(days=LOOKBACK * 3), day)[-LOOKBACK:]
+
+
+def build(snapshot_store: SnapshotStore, day: date) -> pd.Series:
+    """Builds, writes and returns the index of 'day' from the snapshots available in its window."""
+    days = [day_ for day_ in get_window(day) if day_ in snapshot_store]
+
+    # Align every day's relative market caps on the union of their symbols.
+    days_symbols = [snapshot_store.get_column(day_, 'T') for day_ in days]
+    symbols = np.unique(np.concatenate(days_symbols)) if days else np.array([], dtype=object)
+    rel_mkt_caps = np.full((len(days), len(symbols)), np.inf)
+    for i, (day_, day_symbols) in enumerate(zip(days, days_symbols)):
+        positions = np.searchsorted(symbols, day_symbols)
+        rel_mkt_caps[i, positions] = snapshot_store.get_column(day_, 'close') * snapshot_store.get_column(day_, 'volume')
+
+    index = pd.Series(rel_mkt_caps.min(axis=0, initial=np.inf), index=pd.Index(symbols, name='T'), name='min_rel_mkt_cap')
+
+    table = pa.Table.from_arrays([pa.array(symbols, type=pa.string()), pa.array(index.to_numpy())], names=['T', 'min_rel_mkt_cap'])
+    table = table.replace_schema_metadata({'days': json.dumps([str(day_) for day_ in days]),
+                                           'versions': json.dumps(get_snapshot_versions(snapshot_store, days)),
+                                           'splits': get_splits_version(snapshot_store)})
+    feather.write_feather(table, get_index_path(snapshot_store, day), compression='uncompressed')
+
+    _indexes[day] = index
+    return index
+
+
+def is_stale(snapshot_store: SnapshotStore, day: date) -> bool:
+    """Returns 'True' if the index of 'day' is missing or was built from different snapshots or splits."""
+    if not os.path.isfile(index_path := get_index_path(snapshot_store, day)):
+        return True
+
+    metadata = feather.read_table(index_path, memory_map=True).schema.metadata
+    days = [day_ for day_ in get_window(day) if day_ in snapshot_store]
+    return (json.loads(metadata[b'days']) != [str(day_) for day_ in days] or
+            json.loads(metadata.get(b'versions', b'null')) != get_snapshot_versions(snapshot_store, days) or
+            metadata.get(b'splits', b'').decode() != get_splits_version(snapshot_store))
+
+
+def get_snapshot_versions(snapshot_store: SnapshotStore, days: List[date]) -> List[int]:
+    """Snapshots are rewritten, e.g. when reconciled with Polygon.io, so an index is stale once one is rewritten."""
+    return [os.stat(snapshot_store.get_path(day_)).st_mtime_ns for day_ in days]
+
+
+def get_splits_version(snapshot_store: SnapshotStore) -> str:
+    """Closes are split adjusted, so an index is stale once new splits are recorded."""
+    return snapshot_store.split_adjustments.version if snapshot_store.split_adjustments else ''
+
+
+def update(snapshot_store: SnapshotStore, day: date):
+    """Builds the index of 'day' if it is missing or stale. Indexes of other days are left untouched."""
+    if is_stale(snapshot_store, day):
+        build(snapshot_store, day)
+
+
+def invalidate(day: Optional[date] = None):
+    """Drops the cached index of 'day', or every cached index if 'day' is 'None'."""
+    if day is None:
+        _indexes.clear()
+    else:
+        _indexes.pop(day, None)
+
+
+def get(snapshot_store: SnapshotStore, day: date) -> pd.Series:
+    """Returns the index of 'day', indexed by symbol."""
+    index = _indexes.get(day)
+    if index is None:
+        update(snapshot_store, day)
+        if (index := _indexes.get(day)) is None:
+            df = feather.read_table(get_index_path(snapshot_store, day)).to_pandas()
+            index = df.set_index('T')['min_rel_mkt_cap']
+            _indexes[day] = index
+    return index
+
+
+def get_mask(snapshot_store: SnapshotStore, market_snapshot: pd.DataFrame, min_rel_mkt_cap: int,
+             day: Optional[date] = None) -> np.ndarray:
+    """
+    Returns a mask of the symbols in 'market_snapshot' whose relative market cap stayed at or above
+    'min_rel_mkt_cap' over the window of 'day' (yesterday by default) and in 'market_snapshot' itself.
+    """
+    if day is None:
+        day = t_util.add_to_mkt_date(-1)
+
+    past_rel_mkt_caps = get(snapshot_store, day).reindex(market_snapshot.index, fill_value=np.inf).to_numpy()
+    rel_mkt_caps = (storage_format.decode_price_column(market_snapshot['close']) * market_snapshot['volume']).to_numpy()
+    return np.minimum(past_rel_mkt_caps, rel_mkt_caps) >= min_rel_mkt_cap
+
+
+def get_symbols(snapshot_store: SnapshotStore, min_rel_mkt_cap: int, day: Optional[date] = None) -> pd.Index:
+    """
+    Returns the symbols whose relative market cap stayed at or above 'min_rel_mkt_cap' over the window of 'day'
+    (yesterday by default), i.e. the symbols 'get_mask' can select apart from ones missing from the index.
+    """
+    if day is None:
+        day = t_util.add_to_mkt_date(-1)
+
+    index = get(snapshot_store, day)
+    return index.index[index.to_numpy() >= min_rel_mkt_cap]
@@ -0,0 +1,76 @@
+from typing import Any, Iterable, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+"""
+Declarative filters on the rows of market snapshots, e.g. ('close', 'between', (5, 20)), ('volume', '>=', 1e6) or
+('symbol', 'in', ['AAPL', 'MSFT']).
+
+A filter is a (column, operator, value) tuple. Every operator but 'in' selects a range of a numeric column, so the
+snapshot store evaluates it with binary searches in its sorted index of the column. 'in' only applies to 'symbol'.
+Rows where the column is NaN never pass a range.
+"""
+
+Filter = Tuple[str, str, Any]
+
+RANGE_OPERATORS = ['==', '>', '>=', '<', '<=', 'between']
+
+
+def normalize(filters: Optional[Iterable[Filter]]) -> Tuple[Filter, ...]:
+    """Validates 'filters' and returns them as a hashable, ordered tuple, so equal filters merge."""
+    normalized = set()
+    for column, operator, value in filters or ():
+        if operator == 'in':
+            if column != 'symbol':
+                raise ValueError(f"Only 'symbol' can be filtered with 'in', not {column!r}")
+            value = tuple(sorted(set(value)))
+        elif operator == 'between':
+            low, high = value
+            value = (float(low), float(high))
+        elif operator in RANGE_OPERATORS:
+            value = float(value)
+        else:
+            raise ValueError(f'Unknown filter operator {operator!r}')
+        normalized.add((column, operator, value))
+    return tuple(sorted(normalized, key=str))
+
+
+def get_range(operator: str, value: Any) -> Tuple[float, float, bool, bool]:
+    """Returns the low and high bounds of a range filter, and whether each is inclusive."""
+    if operator == '==':
+        return value, value, True, True
+    if operator == 'between':
+        return value[0], value[1], True, True
+    if operator in ('>', '>='):
+        return value, np.inf, operator == '>=', True
+    return -np.inf, value, True, operator == '<='
+
+
+def get_mask(market_snapshot: pd.DataFrame, filters: Tuple[Filter, ...]) -> np.ndarray:
+    """
+    Returns the mask of the symbols of 'market_snapshot', indexed by symbol, passing every filter of 'filters'. For
+    snapshots the snapshot store does not index, e.g. live ones.
+    """
+    mask = np.ones(len(market_snapshot), dtype=bool)
+    for column, operator, value in filters:
+        if operator == 'in':
+            mask &= market_snapshot.index.isin(value)
+        elif column not in market_snapshot.columns:
+            mask[:] = False
+        else:
+            values = market_snapshot[column].to_numpy(dtype=np.float64, na_value=np.nan)
+            low, high, low_inclusive, high_inclusive = get_range(operator, value)
+            with np.errstate(invalid='ignore'):
+                mask &= ((values >= low) if low_inclusive else (values > low)) & \
+                    ((values <= high) if high_inclusive else (values < high))
+    return mask
+
+
+def get_symbols(filters: Tuple[Filter, ...]) -> Optional[Set[str]]:
+    """Returns the symbols 'filters' restrict a snapshot to, or 'None' if they do not filter on symbols."""
+    symbols = None
+    for column, operator, value in filters:
+        if operator == 'in':
+            symbols = set(value) if symbols is None else symbols & set(value)
+    return symbols
@@ -0,0 +1,62 @@
+import os
+from datetime import datetime
+from queue import Queue
+from threading import Thread
+from typing import Optional, Tuple
+
+import pandas as pd
+
+from files import MIDAS_PATH
+from files.config import Config
+from logger import log
+
+"""
+Records the live market snapshots handed to strategies, for debugging.
+
+Snapshots are queued and written by a background thread as compressed feather files to
+'data/recordings/<date>/<time>_<label>.feather', so recording costs the live data path no more than a queue put.
+Enabled by 'live_data.record_snapshots'.
+"""
+
+_queue: Queue[Optional[Tuple[datetime, str, pd.DataFrame]]] = Queue()
+_writer_thread: Optional[Thread] = None
+recordings_path = os.path.join(MIDAS_PATH, 'data', 'recordings')
+
+
+def is_enabled() -> bool:
+    return Config.get('live_data.record_snapshots', False)
+
+
+def record(recorded_at: datetime, label: str, market_snapshot: pd.DataFrame):
+    """
+    Queues 'market_snapshot' to be written by the writer thread, which is started on the first call.
+
+    Notes
+    -----
+    'market_snapshot' is written as it is when it is dequeued, so it must not be modified afterwards.
+
+    """
+    global _writer_thread
+    if _writer_thread is None or not _writer_thread.is_alive():
+        _writer_thread = Thread(target=_write_loop, name='snapshot_recorder', daemon=True)
+        _writer_thread.start()
+    _queue.put((recorded_at, label, market_snapshot))
+
+
+def stop():
+    """Writes the snapshots queued so far and stops the writer thread."""
+    if _writer_thread is not None and _writer_thread.is_alive():
+        _queue.put(None)
+        _writer_thread.join()
+
+
+def _write_loop():
+    while (item := _queue.get()) is not None:
+        recorded_at, label, market_snapshot = item
+        day_path = os.path.join(recordings_path, str(recorded_at.date()))
+        try:
+            os.makedirs(day_path, exist_ok=True)
+            market_snapshot.reset_index().to_feather(
+                os.path.join(day_path, f'{recorded_at.strftime("%H%M%S")}_{label}.feather'), compression='zstd')
+        except Exception as e:
+            log('market_data/recorder', f'Failed to record the {label} snapshot of {recorded_at}: {e!r}')
@@ -0,0 +1,281 @@
+import os
+from collections import OrderedDict
+from datetime import date
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from data import snapshot_filters, storage_format
+from data.snapshot_filters import Filter
+from data.split_adjustments import SplitAdjustments, PRICE_COLUMNS
+from files.config import Config
+
+
+class SnapshotStore:
+    """
+    Memory-maps market snapshot files and hands out views of their columns.
+
+    Parameters
+    ----------
+    snapshots_path : str
+        Directory holding the '<date>.feather' market snapshots.
+    split_adjustments : optional, SplitAdjustments
+        If given, price columns are adjusted for splits executed after the snapshot's day when they are read.
+    max_bytes : optional, int
+        Bytes of snapshots kept open before the least recently used days are dropped. Read from
+        'snapshots.cache_bytes' when first needed if not given.
+
+    Methods
+    -------
+    get_table : pa.Table
+        Returns the memory-mapped table of a day's market snapshot.
+    get_column : np.ndarray
+        Returns a read-only view of one column of a day's market snapshot, or its float64 prices.
+    get_dataframe : pd.DataFrame
+        Returns a day's market snapshot indexed by symbol, built on top of the memory-mapped columns. Its prices are
+        read with 'storage_format.decode_price_column'.
+    evict :
+        Drops a day from the store so its file can be rewritten.
+    get_sorted_column : Tuple[np.ndarray, np.ndarray]
+        Returns the sorted index of one column of a day's market snapshot.
+    query : np.ndarray
+        Returns the mask of the symbols of a day's market snapshot passing filters.
+    get_nbytes : int
+        Returns the bytes of the days kept open.
+
+    Notes
+    -----
+    Snapshots of every storage format version are read. Prices stored as ticks without nulls are kept as ticks in the
+    DataFrames, memory-mapped, and decoded by the views of the DataFrames. Any other prices are kept as float64.
+    Snapshots are only zero-copy when the file was written uncompressed. Compressed files are still readable, but
+    their columns are decompressed into memory once, when the day is first opened.
+    A price column is copied when, and only when, one of its symbols has split since the snapshot's day.
+    Days are kept open across reloads, so a lookback window sliding forward by a day only opens the new day. A day's
+    bytes are its table's, memory-mapped or not, plus its symbols, split adjusted columns and sorted indexes.
+    Split adjusted DataFrames and sorted indexes are built for the splits recorded when they are built, and dropped
+    once splits are added, so they are rebuilt adjusted for them when next read.
+
+    """
+    def __init__(self, snapshots_path: str, split_adjustments: Optional[SplitAdjustments] = None,
+                 max_bytes: Optional[int] = None):
+        self.snapshots_path = snapshots_path
+        self.split_adjustments = split_adjustments
+        self.max_bytes = max_bytes
+        # Ordered from least to most recently used.
+        self._tables: OrderedDict[date, pa.Table] = OrderedDict()
+        self._indexes: Dict[date, pd.Index] = dict()
+        self._dataframes: Dict[date, pd.DataFrame] = dict()
+        self._sorted_columns: Dict[date, Dict[str, Tuple[np.ndarray, np.ndarray]]] = dict()
+        self._nbytes: Dict[date, int] = dict()
+        # Bytes of the DataFrames and sorted indexes of each day, dropped when splits are added.
+        self._adjusted_nbytes: Dict[date, int] = dict()
+        self._split_version = self.get_split_version()
+        self._lock = Lock()
+
+    def get_path(self, day: date) -> str:
+        return os.path.join(self.snapshots_path, f'{day}.feather')
+
+    def get_table(self, day: date) -> pa.Table:
+        with self._lock:
+            table = self._tables.get(day)
+            if table is None:
+                table = feather.read_table(self.get_path(day), memory_map=True)
+                self._tables[day] = table
+                self._nbytes[day] = table.nbytes
+                self._evict_least_recently_used()
+            else:
+                self._tables.move_to_end(day)
+        return table
+
+    def get_column(self, day: date, column: str, adjusted: bool = True) -> np.ndarray:
+        chunked_array = self.get_table(day).column(column)
+        if column == 'T':
+            return storage_format.decode_symbols(chunked_array)
+        array = chunked_array.chunk(0) if chunked_array.num_chunks == 1 else chunked_array.combine_chunks()
+        if column not in PRICE_COLUMNS:
+            return array.to_numpy(zero_copy_only=False)
+
+        prices = storage_format.decode_prices(array)
+        if adjusted and self.split_adjustments:
+            prices = self.split_adjustments.adjust(day, self.get_symbols(day), prices)
+        return prices
+
+    def get_symbols(self, day: date) -> pd.Index:
+        """Returns the symbols of a day's market snapshot. The index is built once per day and shared."""
+        index = self._indexes.get(day)
+        if index is None:
+            index = pd.Index(self.get_column(day, 'T'), name='T')
+            self._add_to_day(day, index.memory_usage(deep=True), index=index)
+        return index
+
+    def get_dataframe(self, day: date, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Columns that are requested but missing from the snapshot, e.g. 'vwap' in older snapshots, are all NaN."""
+        # Opens the day, or marks it as the most recently used.
+        self.get_table(day)
+        split_version = self.update_split_version()
+        if (market_snapshot := self._dataframes.get(day)) is None:
+            market_snapshot = self._build_dataframe(day, split_version)
+
+        if columns is None:
+            return market_snapshot.copy(deep=False)
+        columns = [column for column in columns if column != 'T']
+
+        # Selecting columns is copy-on-write, so the day's columns are not copied.
+        market_snapshot = market_snapshot[[column for column in columns if column in market_snapshot.columns]]
+        for column in columns:
+            if column not in market_snapshot.columns:
+                market_snapshot[column] = np.nan
+        return market_snapshot
+
+    def _build_dataframe(self, day: date, split_version: str) -> pd.DataFrame:
+        """
+        Builds the split adjusted market snapshot of 'day', with every column of its file, and keeps it if no splits
+        were added since 'split_version'.
+        """
+        table = self.get_table(day)
+
+        # 'split_blocks' keeps each column in its own block, so no column is copied to consolidate them.
+        market_snapshot = table.select([column for column in table.column_names if column != 'T']) \
+            .to_pandas(split_blocks=True, use_threads=False)
+        market_snapshot.index = self.get_symbols(day)
+
+        # Decode prices and adjust them for splits. Ticks and float64 prices are only copied if they are adjusted, or
+        # the ticks have nulls.
+        nbytes = 0
+        for column in set(market_snapshot.columns).intersection(PRICE_COLUMNS):
+            stored_prices = table.column(column)
+            prices = storage_format.decode_prices(stored_prices)
+            adjusted_prices = self.split_adjustments.adjust(day, market_snapshot.index, prices) \
+                if self.split_adjustments else prices
+            if adjusted_prices is not prices or not (stored_prices.type == pa.float64() or
+                                                     stored_prices.type == pa.int32() and not stored_prices.null_count):
+                market_snapshot[column] = adjusted_prices
+                nbytes += adjusted_prices.nbytes
+
+        self._add_to_day(day, nbytes, market_snapshot=market_snapshot, split_version=split_version)
+        return market_snapshot
+
+    def get_sorted_column(self, day: date, column: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the positions of the rows of a day's market snapshot ordered by 'column', NaNs last, and the sorted
+        values of 'column'. Sorted once per day and column.
+        """
+        split_version = self.update_split_version()
+        sorted_column = self._sorted_columns.get(day, dict()).get(column)
+        if sorted_column is None:
+            # Prices are sorted as the prices they were written from, the values views hand out and live snapshots
+            # are filtered on, so filters select the same symbols on both.
+            values = self.get_column(day, column).astype(np.float64, copy=False)
+            order = np.argsort(values, kind='stable').astype(np.int32)
+            sorted_column = (order, values[order])
+            self._add_to_day(day, order.nbytes + sorted_column[1].nbytes, sorted_column=(column, sorted_column),
+                             split_version=split_version)
+        return sorted_column
+
+    def query(self, day: date, filters: Tuple[Filter, ...]) -> np.ndarray:
+        """
+        Returns the mask of the symbols of a day's market snapshot passing every filter of 'filters'. Range filters are
+        binary searches in the sorted index of their column, so only the rows passing them are touched.
+        """
+        symbols = self.get_symbols(day)
+        mask = np.ones(len(symbols), dtype=bool)
+        for column, operator, value in filters:
+            if operator == 'in':
+                positions = symbols.get_indexer(list(value))
+                positions = positions[positions >= 0]
+            elif column not in self.get_table(day).column_names:
+                positions = np.empty(0, dtype=np.int64)
+            else:
+                order, sorted_values = self.get_sorted_column(day, column)
+                low, high, low_inclusive, high_inclusive = snapshot_filters.get_range(operator, value)
+                # NaNs are sorted last, after any bound, so they are never in range.
+                start = np.searchsorted(sorted_values, low, side='left' if low_inclusive else 'right')
+                end = np.searchsorted(sorted_values, high, side='right' if high_inclusive else 'left')
+                positions = order[start:end]
+
+            passing = np.zeros(len(symbols), dtype=bool)
+            passing[positions] = True
+            mask &= passing
+        return mask
+
+    def _add_to_day(self, day: date, nbytes: int, index: Optional[pd.Index] = None,
+                    market_snapshot: Optional[pd.DataFrame] = None,
+                    sorted_column: Optional[Tuple[str, Tuple[np.ndarray, np.ndarray]]] = None,
+                    split_version: Optional[str] = None):
+        """
+        Keeps 'index', 'market_snapshot' or 'sorted_column', taking 'nbytes' on top of the day's table, if 'day' is
+        still open. 'market_snapshot' and 'sorted_column', built for the splits of 'split_version', are only kept if
+        no splits were added since.
+        """
+        with self._lock:
+            if day not in self._tables:
+                return
+            if index is not None:
+                self._indexes[day] = index
+            if market_snapshot is not None or sorted_column is not None:
+                if split_version != self._split_version:
+                    return
+                self._adjusted_nbytes[day] = self._adjusted_nbytes.get(day, 0) + nbytes
+            if market_snapshot is not None:
+                self._dataframes[day] = market_snapshot
+            if sorted_column is not None:
+                self._sorted_columns.setdefault(day, dict())[sorted_column[0]] = sorted_column[1]
+            self._nbytes[day] += nbytes
+            self._evict_least_recently_used()
+
+    def get_split_version(self) -> str:
+        return self.split_adjustments.version if self.split_adjustments else ''
+
+    def update_split_version(self) -> str:
+        """
+        Drops the split adjusted DataFrames and sorted indexes of every day if splits were added since they were built.
+        Returns the version of the splits recorded.
+        """
+        split_version = self.get_split_version()
+        if split_version != self._split_version:
+            with self._lock:
+                for day, nbytes in self._adjusted_nbytes.items():
+                    self._nbytes[day] -= nbytes
+                self._adjusted_nbytes = dict()
+                self._dataframes = dict()
+                self._sorted_columns = dict()
+                self._split_version = split_version
+        return split_version
+
+    def _evict_least_recently_used(self):
+        """Drops the least recently used days, but the most recent, until the store is within 'max_bytes'."""
+        if self.max_bytes is None:
+            self.max_bytes = Config.get('snapshots.cache_bytes', 2 * 1024 ** 3)
+        while len(self._tables) > 1 and sum(self._nbytes.values()) > self.max_bytes:
+            self._drop(next(iter(self._tables)))
+
+    def _drop(self, day: date):
+        self._tables.pop(day, None)
+        self._indexes.pop(day, None)
+        self._dataframes.pop(day, None)
+        self._sorted_columns.pop(day, None)
+        self._nbytes.pop(day, None)
+        self._adjusted_nbytes.pop(day, None)
+
+    def get_nbytes(self) -> int:
+        return sum(self._nbytes.values())
+
+    def evict(self, day: date):
+        with self._lock:
+            self._drop(day)
+
+    def clear(self):
+        with self._lock:
+            self._tables = OrderedDict()
+            self._indexes = dict()
+            self._dataframes = dict()
+            self._sorted_columns = dict()
+            self._nbytes = dict()
+            self._adjusted_nbytes = dict()
+
+    def __contains__(self, day: date) -> bool:
+        return day in self._tables or os.path.isfile(self.get_path(day))
@@ -0,0 +1,96 @@
+from datetime import date
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data import storage_format
+from data.storage_format import PRICE_COLUMNS
+
+
+class SnapshotView:
+    """
+    A data request's view of a day's base market snapshot: a subset of its columns and rows, rounded when it is
+    materialized.
+
+    Parameters
+    ----------
+    day : date
+        Day of the market snapshot.
+    base : pd.DataFrame
+        The day's market snapshot, with every column requested on the day. Shared by the views of every data request
+        on the day.
+    columns : Tuple[str, ...]
+        Columns of 'base' in the view.
+    mask : optional, np.ndarray
+        Boolean mask of the rows of 'base' in the view. Every row is in the view if 'None'.
+    round_to : int
+        The decimal the view is rounded to when it is materialized.
+
+    Notes
+    -----
+    A view only holds its mask, so a day's market snapshot is held once however many data requests read it.
+    'to_dataframe' takes the view's rows and columns and rounds them each time it is called.
+
+    """
+    def __init__(self, day: date, base: pd.DataFrame, columns: Tuple[str, ...], mask: Optional[np.ndarray],
+                 round_to: int):
+        self.day = day
+        self.base = base
+        self.columns = columns
+        self.mask = mask
+        self.round_to = round_to
+        self._column_positions = base.columns.get_indexer(list(columns))
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self), len(self.columns)
+
+    def __len__(self):
+        return len(self.base) if self.mask is None else int(np.count_nonzero(self.mask))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        rows = slice(None) if self.mask is None else self.mask
+        market_snapshot = self.base.iloc[rows, self._column_positions]
+        # Prices kept as ticks are handed out as float64 prices.
+        for column in [column for column, dtype in market_snapshot.dtypes.items()
+                       if column in PRICE_COLUMNS and dtype == np.int32]:
+            market_snapshot[column] = storage_format.decode_price_column(market_snapshot[column])
+        return market_snapshot.round(self.round_to)
+
+    def get_nbytes(self) -> int:
+        """Returns the bytes the view holds on top of its base."""
+        return 0 if self.mask is None else self.mask.nbytes
+
+    def get_materialized_nbytes(self) -> int:
+        """Returns the bytes the view would take as a DataFrame of its own."""
+        nrows = len(self)
+        index_nbytes = self.base.index.memory_usage(deep=True) * nrows // max(len(self.base), 1)
+        return nrows * sum(self.base.dtypes.iloc[position].itemsize for position in self._column_positions) + \
+            index_nbytes
+
+
+def get_memory_report(views: List[SnapshotView]) -> pd.DataFrame:
+    """
+    Returns, for each day of 'views', the number of views, the bytes of the shared base snapshot and of the views'
+    masks, the bytes the views would take as separate DataFrames and the bytes saved by sharing the base.
+
+    Notes
+    -----
+    Memory-mapped columns of a base are counted even though they are backed by the snapshot file, so the savings are
+    a lower bound.
+
+    """
+    report = dict()
+    for view in views:
+        day_report = report.setdefault(view.day, {'views': 0, 'base_bytes': 0, 'view_bytes': 0, 'copies_bytes': 0})
+        if not day_report['views']:
+            day_report['base_bytes'] = int(view.base.memory_usage(index=True, deep=True).sum())
+        day_report['views'] += 1
+        day_report['view_bytes'] += view.get_nbytes()
+        day_report['copies_bytes'] += view.get_materialized_nbytes()
+
+    report = pd.DataFrame.from_dict(report, orient='index',
+                                    columns=['views', 'base_bytes', 'view_bytes', 'copies_bytes']).sort_index()
+    report['saved_bytes'] = report['copies_bytes'] - report['base_bytes'] - report['view_bytes']
+    return report
@@ -0,0 +1,176 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data import storage_format
+from data.storage_format import PRICE_COLUMNS
+
+
+class SplitAdjustments:
+    """
+    Table of stock splits used to adjust historical prices when they are read, instead of rewriting history.
+
+    Parameters
+    ----------
+    path : str
+        Feather file the table is stored in. It holds one row per split with the columns 'T' (symbol), 'date'
+        (execution date) and 'factor' ('split_from' / 'split_to').
+
+    Methods
+    -------
+    add : int
+        Records splits returned by Polygon.io and returns the number of new splits.
+    get_factors : pd.Series
+        Returns the cumulative factor, by symbol, prices of a given day must be multiplied by.
+    adjust : np.ndarray
+        Adjusts a column of prices of a given day.
+
+    Notes
+    -----
+    Prices of a day are adjusted for every split executed after that day. Stock data files are stored unadjusted too,
+    and only adjusted in the copy written by 'materialize'.
+
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._factors: Dict[date, pd.Series] = dict()
+        self._lock = Lock()
+
+        if os.path.isfile(path):
+            self.table = pd.read_feather(path)
+        else:
+            self.table = pd.DataFrame({'T': pd.Series(dtype=str),
+                                       'date': pd.Series(dtype='datetime64[ns]'),
+                                       'factor': pd.Series(dtype=float)})
+        self._version = get_version(self.table)
+
+    @property
+    def version(self) -> str:
+        """
+        Changes every time the splits change, including a corrected factor of a recorded split. Used to tell if data
+        built from adjusted prices is stale.
+        """
+        return self._version
+
+    def add(self, splits: List[Dict[str, Any]]) -> int:
+        if not splits:
+            return 0
+
+        new_splits = pd.DataFrame({
+            'T': [split['ticker'] for split in splits],
+            'date': pd.to_datetime([split['execution_date'] for split in splits]),
+            'factor': [split['split_from'] / split['split_to'] for split in splits]
+        })
+
+        with self._lock:
+            table = pd.concat([self.table, new_splits], ignore_index=True)
+            table = table.drop_duplicates(subset=['T', 'date'], keep='last', ignore_index=True)
+            added = len(table) - len(self.table)
+            self.table = table.sort_values(by=['T', 'date'], ignore_index=True)
+            self.table.to_feather(self.path)
+            self._factors = dict()
+            self._version = get_version(self.table)
+
+        return added
+
+    def get_factors(self, day: date) -> pd.Series:
+        factors = self._factors.get(day)
+        if factors is None:
+            table = self.table
+            splits_after_day = table[table['date'] > pd.Timestamp(day)]
+            factors = splits_after_day.groupby('T')['factor'].prod()
+            factors = factors[factors != 1]
+            self._factors[day] = factors
+        return factors
+
+    def adjust(self, day: date, symbols: pd.Index, prices: np.ndarray) -> np.ndarray:
+        """
+        Returns 'prices' (aligned with 'symbols') adjusted for splits after 'day'.
+        'prices' itself is returned, untouched, when no symbol needs adjusting.
+        """
+        factors = self.get_factors(day)
+        if factors.empty:
+            return prices
+
+        positions = symbols.get_indexer(factors.index)
+        found = positions >= 0
+        if not found.any():
+            return prices
+
+        positions = positions[found]
+        adjusted_prices = prices.astype(float, copy=True)
+        adjusted_prices[positions] = np.round(adjusted_prices[positions] * factors.to_numpy()[found], 4)
+        return adjusted_prices
+
+    def materialize(self, snapshots_path: str, stocks_path: str, dest_path: str,
+                    max_workers: Optional[int] = None) -> int:
+        """
+        Writes a split adjusted copy of every snapshot and stock data file to 'dest_path', in parallel.
+        Returns the number of files written.
+        """
+        jobs: List[Tuple[str, str, Optional[Dict[str, float]], Optional[pd.DataFrame]]] = []
+
+        os.makedirs(os.path.join(dest_path, 'snapshots'), exist_ok=True)
+        # Only finished files, not the temporary files of writes.
+        for file in [file for file in os.listdir(snapshots_path) if file.endswith('.feather')]:
+            day = datetime.strptime(file.split('.')[0], '%Y-%m-%d').date()
+            jobs.append((os.path.join(snapshots_path, file), os.path.join(dest_path, 'snapshots', file),
+                         self.get_factors(day).to_dict(), None))
+
+        for symbol in os.listdir(stocks_path):
+            os.makedirs(os.path.join(dest_path, 'stocks', symbol), exist_ok=True)
+            symbol_splits = self.table[self.table['T'] == symbol]
+            for file in [file for file in os.listdir(os.path.join(stocks_path, symbol)) if file.endswith('.feather')]:
+                jobs.append((os.path.join(stocks_path, symbol, file), os.path.join(dest_path, 'stocks', symbol, file),
+                             None, symbol_splits))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_materialize_file, *zip(*jobs)))
+
+        return len(jobs)
+
+
+def get_version(table: pd.DataFrame) -> str:
+    """Returns a hash of the splits of 'table'. It is stored in the metadata of indexes, so it is stable across runs."""
+    return hashlib.sha1(pd.util.hash_pandas_object(table, index=False).to_numpy().tobytes()).hexdigest()[:16]
+
+
+def _materialize_file(src: str, dest: str, factors: Optional[Dict[str, float]], symbol_splits: Optional[pd.DataFrame]):
+    """Writes a split adjusted copy of 'src' to 'dest'. Runs in a worker process of 'SplitAdjustments.materialize'."""
+    df = storage_format.read_dataframe(src)
+
+    # Market snapshot.
+    if factors is not None:
+        adjust_by = df['T'].map(factors).fillna(1).to_numpy()
+        for column in [column for column in PRICE_COLUMNS if column in df]:
+            df[column] = np.where(adjust_by != 1, np.round(df[column].to_numpy() * adjust_by, 4), df[column].to_numpy())
+
+    # Stock data.
+    else:
+        df = adjust_bars(df, symbol_splits)
+
+    storage_format.write(df, dest, 'uncompressed')
+
+
+def adjust_bars(df: pd.DataFrame, symbol_splits: pd.DataFrame) -> pd.DataFrame:
+    """Returns bars ('t' column) of a stock with each bar's prices adjusted for 'symbol_splits' executed after it."""
+    if symbol_splits.empty:
+        return df
+
+    # The factor of a bar is the product of the factors of every split after it.
+    split_dates = symbol_splits['date'].to_numpy()
+    after_factors = np.append(np.cumprod(symbol_splits['factor'].to_numpy()[::-1])[::-1], 1.0)
+    bar_dates = pd.to_datetime(df['t']).to_numpy()
+    bar_factors = after_factors[np.searchsorted(split_dates, bar_dates, side='right')]
+
+    df = df.copy()
+    for column in PRICE_COLUMNS:
+        if column in df:
+            df[column] = np.round(df[column].to_numpy() * bar_factors, 4)
+    return df
@@ -0,0 +1,175 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import feather
+
+from files.config import Config
+
+"""
+Storage format of the market snapshot and stock data feather files.
+
+Version 1, the original format, holds float64 prices, int64 volumes and an object 'T' (symbol) column.
+Version 2 held prices as float32 where they read back exactly, which real prices above about $1024 and VWAPs rarely
+do. Version 3 files:
+- hold each price column as int32 ticks of $0.0001, i.e. the price times 'TICKS', NaNs as nulls. Prices are rounded
+  to the tick, e.g. VWAPs with more decimals. Columns with a price above about $214748, which does not fit in an
+  int32, are held as float64.
+- hold 'T' dictionary encoded.
+- are compressed with 'storage.snapshot_compression' or 'storage.stock_compression' ('uncompressed', 'zstd' or
+  'lz4'). Snapshots are only memory-mapped without copying when uncompressed.
+- record 'FORMAT_VERSION' in the schema metadata under 'METADATA_KEY'. Files without it are version 1.
+
+Prices of every version are read as float64 with 'decode_prices', giving back the prices the file was written with.
+Symbols are read into the global symbol dictionary of the process, so a symbol's string is held once however many
+days are read.
+
+Both versions are read the same way, so files can be migrated in place while Midas runs, with the 'migrate-storage'
+command or from the repository root: python -m data.storage_format <data directory>
+"""
+
+FORMAT_VERSION = 3
+METADATA_KEY = b'midas_format'
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'vwap']
+
+TICKS = 10000  # Ticks of a dollar prices are stored in.
+
+# Global symbol dictionary, only ever appended to, and the strings of its symbols.
+_symbols = pa.array([], pa.string())
+_symbol_strings = np.empty(0, dtype=object)
+_symbols_lock = Lock()
+
+
+def get_version(path: str) -> int:
+    """Returns the storage format version of the feather file at 'path', reading only its schema."""
+    with pa.memory_map(path) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or dict()
+    return int(metadata.get(METADATA_KEY, 1))
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    """Converts 'df' to a table in the current storage format."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column in [column for column in PRICE_COLUMNS if column in table.column_names]:
+        ticks = np.round(df[column].to_numpy(dtype=np.float64, na_value=np.nan) * TICKS)
+        nulls = np.isnan(ticks)
+        # Stored as ticks only if every price fits in an int32.
+        if np.all(nulls | (np.abs(ticks) <= np.iinfo(np.int32).max)):
+            ticks = pa.array(np.where(nulls, 0, ticks).astype(np.int32), mask=nulls if nulls.any() else None)
+            table = table.set_column(table.column_names.index(column), column, ticks)
+    if 'T' in table.column_names:
+        table = table.set_column(table.column_names.index('T'), 'T', table.column('T').dictionary_encode())
+    return table.replace_schema_metadata({**(table.schema.metadata or dict()), METADATA_KEY: str(FORMAT_VERSION)})
+
+
+def write(df: pd.DataFrame, path: str, compression: str):
+    """Writes 'df' to 'path' in the current storage format, compressed with 'compression'."""
+    feather.write_feather(to_table(df), path, compression=compression)
+
+
+def decode_prices(prices: Union[pa.Array, pa.ChunkedArray]) -> np.ndarray:
+    """
+    Returns a price column of a file, of any storage format version, as float64 prices, NaNs for nulls. float64 columns
+    without nulls are not copied.
+    """
+    if pa.types.is_int32(prices.type):
+        # Dividing is correctly rounded, so the ticks give back the nearest float64 to the price, the price written.
+        return prices.cast(pa.float64()).to_numpy(zero_copy_only=False) / TICKS
+    if pa.types.is_float32(prices.type):
+        # Rounded to the smallest tick, recovering the prices the version 2 file was written with.
+        return np.round(prices.cast(pa.float64()).to_numpy(zero_copy_only=False), 4)
+    return prices.to_numpy(zero_copy_only=False)
+
+
+def decode_price_column(prices: pd.Series) -> pd.Series:
+    """Returns a price column of a snapshot store DataFrame as float64 prices, decoding it if it is kept as ticks."""
+    return prices / TICKS if prices.dtype == np.int32 else prices
+
+
+def decode_symbols(symbols: pa.ChunkedArray) -> np.ndarray:
+    """Returns the symbols of a 'T' column as an object array of the strings of the global symbol dictionary."""
+    global _symbols, _symbol_strings
+    symbols = symbols.combine_chunks().cast(pa.string())
+    with _symbols_lock:
+        codes = pc.index_in(symbols, value_set=_symbols)
+        if codes.null_count:
+            new_symbols = pc.unique(symbols.filter(codes.is_null()))
+            _symbols = pa.concat_arrays([_symbols, new_symbols])
+            _symbol_strings = np.concatenate([_symbol_strings, new_symbols.to_numpy(zero_copy_only=False)])
+            codes = pc.index_in(symbols, value_set=_symbols)
+        return _symbol_strings[codes.to_numpy()]
+
+
+def to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """Converts 'table', of any storage format version, to a version 1 DataFrame, with float64 prices and object 'T'."""
+    for column in [column for column in PRICE_COLUMNS if column in table.column_names]:
+        if table.schema.field(column).type != pa.float64():
+            prices = decode_prices(table.column(column))
+            table = table.set_column(table.column_names.index(column), column, pa.array(prices, from_pandas=True))
+    if 'T' not in table.column_names:
+        return table.to_pandas()
+
+    df = table.drop_columns(['T']).to_pandas()
+    df.insert(table.column_names.index('T'), 'T', decode_symbols(table.column('T')))
+    return df
+
+
+def read_dataframe(path: str) -> pd.DataFrame:
+    """Reads the feather file at 'path', of any storage format version, as a version 1 DataFrame."""
+    return to_dataframe(feather.read_table(path))
+
+
+def migrate_file(path: str, compression: str) -> bool:
+    """Rewrites the file at 'path' in the current storage format, if it is not yet. Returns whether it was rewritten."""
+    if get_version(path) == FORMAT_VERSION:
+        return False
+    # Written to a temporary file first and moved over 'path', so tables already memory-mapped from it stay valid.
+    write(read_dataframe(path), f'{path}.tmp', compression)
+    os.replace(f'{path}.tmp', path)
+    return True
+
+
+def migrate(data_folder: str, max_workers: Optional[int] = None) -> Dict[str, int]:
+    """
+    Rewrites every market snapshot and stock data file of 'data_folder' that is not in the current storage format,
+    in parallel. Returns the number of files 'migrated' and 'skipped', and the 'bytes_before' and 'bytes_after' of
+    the files.
+    """
+    paths: List[str] = []
+    for root, _, files in os.walk(os.path.join(data_folder, 'snapshots')):
+        paths.extend(os.path.join(root, file) for file in files if file.endswith('.feather'))
+    for root, _, files in os.walk(os.path.join(data_folder, 'stocks')):
+        paths.extend(os.path.join(root, file) for file in files if file.endswith('.feather'))
+
+    bytes_before = sum(os.path.getsize(path) for path in paths)
+    # Compressions are read here since the worker processes do not read the config.
+    snapshots_path = os.path.join(data_folder, 'snapshots')
+    compressions = [Config.get('storage.snapshot_compression', 'uncompressed') if path.startswith(snapshots_path) else
+                    Config.get('storage.stock_compression', 'lz4') for path in paths]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        migrated = list(executor.map(migrate_file, paths, compressions, chunksize=16))
+
+    return {'migrated': sum(migrated), 'skipped': len(migrated) - sum(migrated), 'bytes_before': bytes_before,
+            'bytes_after': sum(os.path.getsize(path) for path in paths)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrates historical data to the current storage format.')
+    parser.add_argument('data_folder', help="Midas data directory holding 'snapshots' and 'stocks'")
+    args = parser.parse_args()
+
+    Config.read()
+    stats = migrate(args.data_folder)
+    print(f'Migrated {stats["migrated"]} files, skipped {stats["skipped"]}: '
+          f'{stats["bytes_before"] / 1e6:,.1f} MB -> {stats["bytes_after"] / 1e6:,.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+from threading import Lock
+from typing import Callable, Iterable, List, Optional, Set
+
+from data import rel_mkt_cap_index, snapshot_filters
+from data.data_requests.data_request import DataRequest
+from data.data_requests.intraday_bars_data_request import IntradayBarsRequest
+from data.data_requests.market_snapshot_data_request import MarketSnapshotRequest
+from data.data_requests.movers_data_request import MoversRequest
+from data.snapshot_store import SnapshotStore
+from files.config import Config
+from logger import log
+
+"""
+Decides which symbols the 'AM' websocket subscribes to.
+
+Today's universe is derived from the live data requests of the strategies: when every live request filters symbols by
+'shortable' or 'min_rel_mkt_cap', or names them, only the symbols that can pass one of those filters are subscribed
+to. Otherwise, when there are no live requests, or when 'polygon_websocket.subscription' is 'wildcard', every symbol
+is subscribed to with 'AM.*', so forced runs of any strategy and the close-of-day snapshot still see every symbol.
+
+The websocket thread applies changes of the universe by calling 'get_changes', which diffs the universe against what
+is subscribed.
+"""
+
+WILDCARD = 'AM.*'
+
+SYMBOLS_PER_MESSAGE = 500  # Symbols per subscribe or unsubscribe message.
+
+# 'None' means every symbol.
+_universe: Optional[Set[str]] = None
+_subscribed: Optional[Set[str]] = set()
+_lock = Lock()
+
+
+def get_universe(data_requests: List[DataRequest], snapshot_store: SnapshotStore,
+                 get_shortable_symbols: Callable[[], List[str]]) -> Optional[Set[str]]:
+    """
+    Returns the symbols the live requests in 'data_requests' can select, or 'None' if they need every symbol.
+
+    Notes
+    -----
+    Symbols missing from the relative market cap index, e.g. IPOs, are never selected by 'min_rel_mkt_cap' here, even
+    though a live snapshot could select them. Use the 'wildcard' subscription if a strategy needs them.
+
+    """
+    if Config.get('polygon_websocket.subscription', 'dynamic') == 'wildcard':
+        return None
+
+    live_requests = [data_request for data_request in data_requests
+                     if isinstance(data_request, MarketSnapshotRequest) and data_request.day == 0]
+    # Nothing constrains the universe without live requests.
+    if not live_requests:
+        return None
+    if any(not (data_request.shortable or data_request.min_rel_mkt_cap or
+                snapshot_filters.get_symbols(data_request.filters) is not None) for data_request in live_requests):
+        return None
+
+    # Movers are ranked over the whole market.
+    if any(isinstance(data_request, MoversRequest) for data_request in data_requests):
+        return None
+
+    # Intraday bars are only kept for the symbols subscribed to.
+    universe = set()
+    for data_request in data_requests:
+        if isinstance(data_request, IntradayBarsRequest):
+            if data_request.symbols is None:
+                return None
+            universe.update(data_request.symbols)
+
+    shortable_symbols = None
+    for data_request in live_requests:
+        symbols = None
+        if data_request.min_rel_mkt_cap:
+            symbols = set(rel_mkt_cap_index.get_symbols(snapshot_store, data_request.min_rel_mkt_cap))
+        if data_request.shortable:
+            if shortable_symbols is None:
+                shortable_symbols = set(get_shortable_symbols())
+            symbols = shortable_symbols if symbols is None else symbols & shortable_symbols
+        if (filter_symbols := snapshot_filters.get_symbols(data_request.filters)) is not None:
+            symbols = filter_symbols if symbols is None else symbols & filter_symbols
+        universe |= symbols
+
+    if not universe or len(universe) > Config.get('polygon_websocket.max_subscribed_symbols', 5000):
+        return None
+    return universe
+
+
+def set_universe(universe: Optional[Set[str]]):
+    """Sets the symbols to subscribe to. The websocket thread picks the change up with 'get_changes'."""
+    global _universe
+    with _lock:
+        _universe = universe
+    log('market_data/subscription_manager',
+        f'Universe: {"every symbol" if universe is None else f"{len(universe)} symbols"}')
+
+
+def update(data_requests: List[DataRequest], snapshot_store: SnapshotStore,
+           get_shortable_symbols: Callable[[], List[str]]):
+    set_universe(get_universe(data_requests, snapshot_store, get_shortable_symbols))
+
+
+def is_wildcard() -> bool:
+    """Returns 'True' if every symbol is subscribed to."""
+    with _lock:
+        return _universe is None
+
+
+def reset():
+    """Forgets what is subscribed, e.g. when the websocket reconnects, so the whole universe is subscribed again."""
+    global _subscribed
+    with _lock:
+        _subscribed = set()
+
+
+def get_changes() -> List[dict]:
+    """
+    Returns the subscribe and unsubscribe messages that bring the subscription to the universe, and assumes they are
+    sent.
+    """
+    global _subscribed
+    with _lock:
+        universe, subscribed = _universe, _subscribed
+        if universe == subscribed:
+            return []
+        _subscribed = universe
+
+    # Unsubscribing first, so no symbol is ever subscribed to twice and has its bars received twice.
+    if universe is None:
+        return get_messages('unsubscribe', subscribed) + [{'action': 'subscribe', 'params': WILDCARD}]
+    if subscribed is None:
+        return [{'action': 'unsubscribe', 'params': WILDCARD}] + get_messages('subscribe', universe)
+    return get_messages('unsubscribe', subscribed - universe) + get_messages('subscribe', universe - subscribed)
+
+
+def get_messages(action: str, symbols: Iterable[str]) -> List[dict]:
+    params = [f'AM.{symbol}' for symbol in sorted(symbols)]
+    return [{'action': action, 'params': ','.join(params[i:i + SYMBOLS_PER_MESSAGE])}
+            for i in range(0, len(params), SYMBOLS_PER_MESSAGE)]
@@ -0,0 +1,103 @@
+import gzip
+import os
+import struct
+import time
+from datetime import date, datetime, timedelta
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+from pytz import timezone
+
+"""
+Append-only journal of the raw frames received from the websocket, for replaying a day offline.
+
+A journal file holds one day, US/Eastern, of frames. Each frame is written as a little-endian header of its receive
+time in nanoseconds since the epoch (int64) and its length in bytes (uint32), followed by the frame itself:
+
+    <receive time ns: q><length: I><frame: length bytes>
+
+Files are named '<date>.journal', or '<date>.journal.gz' when compressed.
+"""
+
+HEADER = struct.Struct('<qI')
+
+FLUSH_INTERVAL = 1_000_000_000  # Nanoseconds between flushes of the write buffer.
+
+
+class JournalWriter:
+    """
+    Appends frames to the journal of the day they are received on, rotating files at midnight US/Eastern.
+
+    Parameters
+    ----------
+    journal_path : str
+        Directory the journal files are written to.
+    compress : bool
+        Whether to gzip the journal files. Compression runs on the writing thread.
+
+    Notes
+    -----
+    Writes are buffered and flushed at most every 'FLUSH_INTERVAL', so journaling a frame costs a header pack and a
+    buffered write. A crash loses at most the frames of the last interval.
+
+    """
+    def __init__(self, journal_path: str, compress: bool = False):
+        self.journal_path = journal_path
+        self.compress = compress
+        self._file: Optional[BinaryIO] = None
+        self._rotate_at = 0
+        self._last_flush = 0
+        os.makedirs(journal_path, exist_ok=True)
+
+    def write(self, frame: Union[str, bytes], received_at: Optional[int] = None):
+        """Appends 'frame', received at 'received_at' nanoseconds since the epoch (now if not given)."""
+        if received_at is None:
+            received_at = time.time_ns()
+        if isinstance(frame, str):
+            frame = frame.encode()
+
+        if received_at >= self._rotate_at:
+            self._rotate(received_at)
+
+        self._file.write(HEADER.pack(received_at, len(frame)))
+        self._file.write(frame)
+
+        if received_at - self._last_flush >= FLUSH_INTERVAL:
+            self._file.flush()
+            self._last_flush = received_at
+
+    def _rotate(self, received_at: int):
+        self.close()
+
+        day = datetime.fromtimestamp(received_at / 1e9, timezone('US/Eastern')).date()
+        next_midnight = timezone('US/Eastern').localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+        self._rotate_at = int(next_midnight.timestamp()) * 1_000_000_000
+
+        path = get_journal_path(self.journal_path, day, self.compress)
+        # Compressed files are appended to as new gzip members, which readers decompress as one stream.
+        if self.compress:
+            self._file = gzip.open(path, 'ab', compresslevel=1)
+        else:
+            self._file = open(path, 'ab', buffering=1024 * 1024)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._rotate_at = 0
+
+
+def get_journal_path(journal_path: str, day: date, compress: bool) -> str:
+    return os.path.join(journal_path, f'{day}.journal{".gz" if compress else ""}')
+
+
+def read_frames(path: str) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yields the receive time, in nanoseconds since the epoch, and the raw frame of every frame of the journal file at
+    'path', in the order they were received. A frame cut off by a crash ends the journal.
+    """
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb', buffering=1024 * 1024)) as file:
+        while len(header := file.read(HEADER.size)) == HEADER.size:
+            received_at, length = HEADER.unpack(header)
+            if len(frame := file.read(length)) < length:
+                return
+            yield received_at, frame
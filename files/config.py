@@ -1,10 +1,13 @@
 import yaml
 import platform
+from typing import Any
 
 from files.file import File
 from files import MIDAS_PATH
 from utils import utils
 
+_NO_DEFAULT = object()
+
 
 class Config(File):
     """
@@ -15,7 +18,7 @@ class Config(File):
     read :
         Reads the contents of the config file and stores it.
     get : str
-        Returns the func of the key in the config.
+        Returns the func of the key in the config, or 'default' if given and the key is not in the config.
 
     Notes
     -----
@@ -37,5 +40,7 @@ class Config(File):
             Config.data = utils.flatten_dict(yaml.load(file, Loader=yaml.loader.SafeLoader))
 
     @staticmethod
-    def get(key: str):
+    def get(key: str, default: Any = _NO_DEFAULT):
+        if default is not _NO_DEFAULT and key not in Config.data:
+            return default
         return Config.data[key]
@@ -49,7 +49,7 @@ def setup_data_dir():
     ensure_dir_exists('data')
 
     # Create sub directories
-    sub_directories = ['snapshots', 'stocks']
+    sub_directories = ['snapshots', 'stocks', 'rel_mkt_caps']
     create_sub_directories('data', sub_directories)
 
     # Create splits file
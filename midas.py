@@ -9,6 +9,7 @@ from files.config import Config
 from time import sleep
 
 import strategy_runner
+from data import snapshot_recorder
 from logger import log
 from strategies.strategy import Strategy
 from utils import cli_util, t_util
@@ -60,5 +61,8 @@ def run_midas():
     except Exception:
         alert.alert(traceback.format_exc()[:-1])
         main.end_midas.set()
+
+    # Write the live snapshots still queued to be recorded.
+    snapshot_recorder.stop()
     cli_util.output(color.YELLOW + 'Midas thread exited')
     exit()
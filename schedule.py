@@ -1,5 +1,5 @@
 import inspect
-from datetime import datetime, time
+from datetime import date, datetime, time
 from pytz import timezone
 from typing import List, Callable, Union
 
@@ -54,8 +54,13 @@ def get_next_strategy_run_time() -> datetime:
 
 
 def get_today_strategy_funcs() -> List[Callable]:
+    return get_strategy_funcs(t_util.get_today())
+
+
+def get_strategy_funcs(day: date) -> List[Callable]:
+    """Gets the strategy functions scheduled to run on 'day'."""
     strategies = set()
-    for funcs in {run_time: funcs for run_time, funcs in schedule.items() if run_time.date() == t_util.get_today()}.values():
+    for funcs in {run_time: funcs for run_time, funcs in schedule.items() if run_time.date() == day}.values():
         for func in funcs:
             if inspect.ismethod(func) and Strategy in func.__self__.__class__.__bases__:
                 strategies.add(func)
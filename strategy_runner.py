@@ -2,6 +2,7 @@ import asyncio
 import copy
 from typing import List, Callable, Dict
 
+import alert
 import portfolio_manager
 import positions
 import schedule
@@ -255,12 +256,16 @@ def get_orders(funcs: List[Callable], tda_account_id: int) -> List[Order]:
     orders = []
     for func in funcs:
         strategy = strategy_list.get_by_name(func.__self__.__class__().name)
+        data_request = strategy.get_buy_data_request() if func.__name__ == 'buy' else strategy.get_sell_data_request()
+
+        # Skip the strategy rather than give it data prepared for another day.
+        if data_request and not market_data.is_prepared_for_today():
+            alert.alert(f'Skipped {func.__self__.__class__.__name__}.{func.__name__}: the market data of today is not '
+                        f'loaded')
+            continue
 
         # Get the orders from the strategy
-        if func.__name__ == 'buy':
-            strategy_orders = func(market_data.get(strategy.get_buy_data_request()), tda_account_id)
-        else:
-            strategy_orders = func(market_data.get(strategy.get_sell_data_request()), tda_account_id)
+        strategy_orders = func(market_data.get(data_request), tda_account_id)
 
         # Ensure strategy_orders is a list
         if isinstance(strategy_orders, Order):